@@ -8,9 +8,14 @@ import pytz
 import psycopg2
 import psycopg2.extras
 import pandas as pd
+import numpy as np
+import openpyxl
 import json
 import io
 import os
+import threading
+import time
+import uuid
 import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
@@ -89,6 +94,19 @@ ACOMP_CORTE_FALLBACK_URL = os.getenv('ACOMP_CORTE_FALLBACK_URL') or f"{ACOMP_COR
 ACOMP_CORTE_SSO_LOGOUT_URL = os.getenv('ACOMP_CORTE_SSO_LOGOUT_URL') or f"{ACOMP_CORTE_BASE_URL.rstrip('/')}/sso-logout"
 ACOMP_CORTE_DEFAULT_NEXT = os.getenv('ACOMP_CORTE_DEFAULT_NEXT', '/')
 
+# Tempo que um local sugerido na tela de coleta fica reservado para o usuário/lote
+RESERVA_LOCAL_TTL_MINUTOS = int(os.getenv('RESERVA_LOCAL_TTL_MINUTOS', '15'))
+
+# Intervalo da varredura que marca como CORTADO os lotes completos no estoque (0 desliga)
+LOTES_STATUS_INTERVALO_SEGUNDOS = int(os.getenv('LOTES_STATUS_INTERVALO_SEGUNDOS', '300'))
+
+# Job em segundo plano (ou requisição com Idempotency-Key) sem atualização por esse tempo
+# é dado como interrompido
+JOB_TIMEOUT_MINUTOS = int(os.getenv('JOB_TIMEOUT_MINUTOS', '10'))
+
+# Sem o gatilho de versão em pu_camadas, o catálogo de camadas é relido a cada intervalo
+CATALOGO_CAMADAS_RECARGA_SEGUNDOS = int(os.getenv('CATALOGO_CAMADAS_RECARGA_SEGUNDOS', '60'))
+
 
 @app.context_processor
 def inject_acomp_urls():
@@ -501,16 +519,16 @@ def importar_etiquetas():
             response.headers.add('Access-Control-Allow-Origin', '*')
             return response
         
-        # Ler Excel com engine específico
+        # Ler só o primeiro lote do Excel (modo read-only, sem carregar a planilha inteira)
         try:
-            df = pd.read_excel(file, engine='openpyxl')
+            df = next(ler_planilha_em_lotes(file, linhas_por_lote=3), None)
         except Exception as excel_error:
             response = jsonify({'success': False, 'message': f'Erro ao ler arquivo Excel: {str(excel_error)}'})
             response.headers.add('Access-Control-Allow-Origin', '*')
             return response
         
         # Verificar se tem dados
-        if df.empty:
+        if df is None or df.empty:
             response = jsonify({'success': False, 'message': 'Arquivo vazio'})
             response.headers.add('Access-Control-Allow-Origin', '*')
             return response
@@ -683,28 +701,25 @@ def desenhar_etiqueta_simples(c, x, y, width, height, dados):
         c.setFont("Courier", 8)
         c.drawString(x + 3*mm, y + 3*mm, codigo_barras_texto)
 
-def verificar_e_atualizar_status_lote(lote_vd, lote_pu, cur):
-    """Verifica se todas as peças do lote estão no estoque e atualiza status para CORTADO"""
+def verificar_e_atualizar_status_lote(lote_vd, cur):
+    """Verifica se todas as peças do lote estão no estoque e atualiza status para CORTADO
+
+    As peças no estoque vêm do contador de public.pu_lotes_contagem (mantido por gatilho em
+    pu_inventory); as esperadas, de uma contagem pelo índice de id_lote no plano de corte.
+    """
     try:
         if not lote_vd:
             return False
-            
-        # Contar total de peças do lote na tabela plano_controle_corte_vidro2
-        cur.execute("""
-            SELECT COUNT(*) FROM public.plano_controle_corte_vidro2
-            WHERE id_lote = %s
-        """, (lote_vd,))
-        total_pecas_lote = cur.fetchone()[0]
         
-        if total_pecas_lote == 0:
-            return False
-            
-        # Contar peças do lote que estão no estoque
         cur.execute("""
-            SELECT COUNT(*) FROM public.pu_inventory
-            WHERE lote_vd = %s OR lote_pu = %s
-        """, (lote_vd, lote_pu))
-        pecas_no_estoque = cur.fetchone()[0]
+            SELECT
+                (SELECT COUNT(*) FROM public.plano_controle_corte_vidro2 WHERE id_lote = %(lote)s),
+                COALESCE((SELECT no_estoque FROM public.pu_lotes_contagem WHERE lote_vd = %(lote)s), 0)
+        """, {'lote': lote_vd})
+        contagem = cur.fetchone()
+        if contagem[0] == 0:
+            return False
+        total_pecas_lote, pecas_no_estoque = contagem[0], contagem[1]
         
         # Se todas as peças do lote estão no estoque, marcar como CORTADO
         if pecas_no_estoque >= total_pecas_lote:
@@ -723,124 +738,727 @@ def verificar_e_atualizar_status_lote(lote_vd, lote_pu, cur):
         print(f"DEBUG: Erro ao verificar status do lote {lote_vd}: {e}")
         return False
 
-def sugerir_local_armazenamento(tipo_peca, locais_ocupados, conn):
-    """Sugere local de armazenamento preenchendo horizontalmente E1, F1, G1..."""
+def atualizar_lotes_cortados(cur):
+    """Marca como CORTADO todos os lotes pendentes que já estão completos no estoque
+
+    Uma única instrução: compara o contador de estoque (public.pu_lotes_contagem) dos lotes
+    programados e ainda não cortados com a contagem de peças do lote no plano de corte e
+    atualiza de uma vez as linhas dos lotes completos.
+    Não faz commit. Retorna os lotes atualizados.
+    """
+    cur.execute("""
+        WITH pendentes AS (
+            SELECT DISTINCT c.id_lote
+            FROM public.plano_controle_corte_vidro2 c
+            WHERE (c.pu_cortado IS NULL OR c.pu_cortado != 'CORTADO')
+              AND c.status = 'PROGRAMADO'
+              AND c.id_lote IS NOT NULL AND c.id_lote != ''
+        ), completos AS (
+            SELECT p.id_lote
+            FROM pendentes p
+            JOIN public.pu_lotes_contagem l ON l.lote_vd = p.id_lote
+            WHERE l.no_estoque >= (
+                SELECT COUNT(*) FROM public.plano_controle_corte_vidro2 c WHERE c.id_lote = p.id_lote
+            )
+        ), atualizados AS (
+            UPDATE public.plano_controle_corte_vidro2 c
+            SET pu_cortado = 'CORTADO'
+            FROM completos
+            WHERE c.id_lote = completos.id_lote
+            RETURNING c.id_lote
+        )
+        SELECT DISTINCT id_lote FROM atualizados ORDER BY id_lote
+    """)
+    lotes = [row[0] for row in cur.fetchall()]
+    if lotes:
+        print(f"DEBUG: {len(lotes)} lote(s) marcado(s) como CORTADO: {', '.join(lotes)}")
+    return lotes
+
+def verificar_lotes_periodicamente():
+    """Laço da thread que roda atualizar_lotes_cortados a cada LOTES_STATUS_INTERVALO_SEGUNDOS
+
+    Cada worker do gunicorn tem a sua thread; a trava consultiva faz só um deles varrer os
+    lotes em cada rodada.
+    """
+    while True:
+        time.sleep(LOTES_STATUS_INTERVALO_SEGUNDOS)
+        try:
+            conn = get_db_connection()
+            try:
+                cur = conn.cursor()
+                cur.execute("SELECT pg_try_advisory_xact_lock(hashtext('app_pu_verificar_lotes'))")
+                if cur.fetchone()[0]:
+                    atualizar_lotes_cortados(cur)
+                conn.commit()
+            finally:
+                conn.close()
+        except Exception as e:
+            print(f"Erro na verificação periódica dos lotes: {e}")
+
+class RackTopology:
+    """Topologia dos racks montada a partir de public.pu_locais (locais ativos).
     
-    try:
-        cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+    Compila a ordem de preenchimento horizontal rack a rack: primeiro as colunas E em
+    diante (E1, F1, G1... depois E2, F2...), depois as colunas D até A. Racks e números
+    vêm dos próprios dados, então um RACK4 cadastrado entra na sequência sem mudar código.
+    """
+    
+    LETRA_INICIAL = 'E'
+    RACK_PADRAO = 'COLMEIA'
+    
+    def __init__(self, locais_ativos, versao=None):
+        self.versao = versao
+        self.locais_por_rack = {}
+        for local_info in locais_ativos:
+            posicao = self.decompor_local(local_info['local'])
+            if posicao:
+                self.locais_por_rack.setdefault(local_info['nome'], {})[local_info['local']] = posicao
         
-        # Buscar TODOS os locais ocupados em tempo real (crítico para evitar duplicatas)
-        cur.execute("""
-            SELECT DISTINCT local FROM (
-                SELECT local FROM public.pu_inventory WHERE local IS NOT NULL AND local != ''
-                UNION ALL
-                SELECT local FROM public.pu_otimizadas WHERE local IS NOT NULL AND local != '' AND tipo = 'PU'
-                UNION ALL
-                SELECT local FROM public.pu_manuais WHERE local IS NOT NULL AND local != ''
-            ) AS all_occupied
-        """)
-        locais_ocupados_db = {row['local'] for row in cur.fetchall()}
+        self.racks = sorted(self.locais_por_rack, key=self.chave_natural)
+        self.sequencia = self._compilar_sequencia()
+        self.ordem = {local: i for i, (local, _) in enumerate(self.sequencia)}
+    
+    @staticmethod
+    def decompor_local(local):
+        """'E12' -> ('E', 12); None se o local não segue o padrão letra + número"""
+        local = (local or '').strip()
+        if len(local) < 2 or not local[0].isalpha() or not local[1:].isdigit():
+            return None
+        return local[0].upper(), int(local[1:])
+    
+    @staticmethod
+    def chave_natural(nome):
+        """Ordena RACK2 antes de RACK10"""
+        numeros = ''.join(filter(str.isdigit, nome or ''))
+        return (int(numeros) if numeros else 0, nome or '')
+    
+    def _compilar_sequencia(self):
+        sequencia = []
+        for rack in self.racks:
+            posicoes = self.locais_por_rack[rack]
+            numeros = sorted({num for _, num in posicoes.values()})
+            letras = {}
+            for local, (letra, num) in posicoes.items():
+                letras.setdefault(num, []).append((letra, local))
+            
+            # Primeiro preencher as colunas E em diante, número a número
+            for num in numeros:
+                for letra, local in sorted(letras[num]):
+                    if letra >= self.LETRA_INICIAL:
+                        sequencia.append((local, self.RACK_PADRAO))
+            
+            # Depois preencher D até A (só depois de terminar E em diante)
+            for num in numeros:
+                for letra, local in sorted(letras[num], reverse=True):
+                    if letra < self.LETRA_INICIAL:
+                        sequencia.append((local, self.RACK_PADRAO))
         
-        # Combinar com locais ocupados passados como parâmetro
-        todos_locais_ocupados = locais_ocupados_db | locais_ocupados
+        return sequencia
+
+
+# Cache da topologia por processo; a versão em public.pu_versoes avisa os outros workers
+_topologia_cache = {'topologia': None}
+_topologia_lock = threading.Lock()
+
+def obter_topologia_racks(conn):
+    """Retorna a topologia compilada, recarregando pu_locais apenas quando a versão mudou"""
+    cur = conn.cursor()
+    cur.execute("SELECT versao FROM public.pu_versoes WHERE nome = 'pu_locais'")
+    row = cur.fetchone()
+    versao = row[0] if row else 0
+    
+    topologia = _topologia_cache['topologia']
+    if topologia is not None and topologia.versao == versao:
+        return topologia
+    
+    cur.execute("SELECT local, nome FROM public.pu_locais WHERE status = 'Ativo' ORDER BY local")
+    locais_ativos = [{'local': local, 'nome': nome} for local, nome in cur.fetchall()]
+    
+    topologia = RackTopology(locais_ativos, versao)
+    with _topologia_lock:
+        _topologia_cache['topologia'] = topologia
+    print(f"DEBUG: Topologia dos racks recompilada (versão {versao}): {len(topologia.racks)} rack(s), {len(topologia.sequencia)} locais na sequência")
+    return topologia
+
+def invalidar_topologia_racks(cur):
+    """Avança a versão do layout de pu_locais (na mesma transação da alteração)"""
+    cur.execute("""
+        INSERT INTO public.pu_versoes (nome, versao) VALUES ('pu_locais', 1)
+        ON CONFLICT (nome) DO UPDATE SET versao = public.pu_versoes.versao + 1
+    """)
+    with _topologia_lock:
+        _topologia_cache['topologia'] = None
+
+class LayerCatalog:
+    """Catálogo de camadas (public.pu_camadas) carregado uma vez e servido da memória.
+    
+    Guarda, por (projeto, peca), a expansão em camadas L1/L3/L3_B já convertida em lista e
+    a divisão de pecas_especiais em sub-peças.
+    """
+    
+    COLUNAS_CAMADAS = (('l1', 'L1'), ('l3', 'L3'), ('l3_b', 'L3_B'))
+    
+    def __init__(self, linhas, versao=None):
+        self.versao = versao
+        self._camadas = {}
+        self._especiais = {}
+        for row in linhas:
+            chave = (row['projeto'], row['peca'])
+            self._camadas.setdefault(chave, self.expandir_camadas(row))
+            especiais = (row['pecas_especiais'] or '').strip()
+            if especiais:
+                # Dividir por hífen e vírgula, limpar espaços
+                self._especiais.setdefault(chave, [p.strip() for p in especiais.replace('-', ',').split(',') if p.strip()])
+    
+    @classmethod
+    def expandir_camadas(cls, row):
+        """['L1', 'L3', 'L3', 'L3_B', ...] a partir das quantidades da linha; '-' ou vazio = nenhuma"""
+        camadas = []
+        for coluna, camada in cls.COLUNAS_CAMADAS:
+            valor = row[coluna]
+            if valor and valor != '-' and str(valor).strip():
+                try:
+                    camadas.extend([camada] * int(valor))
+                except (TypeError, ValueError):
+                    camadas.append(camada)
+        return camadas
+    
+    def pecas_especiais(self, projeto, peca):
+        """Sub-peças definidas em pecas_especiais, ou None se a peça não tem"""
+        return self._especiais.get((projeto, peca))
+    
+    def pecas_para_processar(self, projeto, peca):
+        """As peças especiais substituem a peça original quando existem"""
+        especiais = self.pecas_especiais(projeto, peca)
+        return list(especiais) if especiais is not None else [peca]
+    
+    def camadas(self, projeto, peca):
+        """Lista de camadas da peça (vazia se não há cadastro em pu_camadas)"""
+        return list(self._camadas.get((projeto, peca), []))
+    
+    def __len__(self):
+        """Quantidade de (projeto, peça) com camadas cadastradas"""
+        return len(self._camadas)
+
+
+# 'gatilho' passa a True quando preparar_estruturas_alocacao confirma o gatilho de versão
+_catalogo_camadas_cache = {'catalogo': None, 'carregado_em': 0.0, 'gatilho': False}
+_catalogo_camadas_lock = threading.Lock()
+
+def obter_catalogo_camadas(conn):
+    """Retorna o catálogo de camadas, relendo pu_camadas apenas quando a versão mudou
+    
+    A versão em public.pu_versoes é avançada por gatilho a cada alteração em pu_camadas. Sem
+    o gatilho, o catálogo também é relido a cada CATALOGO_CAMADAS_RECARGA_SEGUNDOS.
+    """
+    cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+    cur.execute("SELECT versao FROM public.pu_versoes WHERE nome = 'pu_camadas'")
+    row = cur.fetchone()
+    versao = row[0] if row else 0
+    
+    catalogo = _catalogo_camadas_cache['catalogo']
+    expirado = (not _catalogo_camadas_cache['gatilho']
+                and time.monotonic() - _catalogo_camadas_cache['carregado_em'] >= CATALOGO_CAMADAS_RECARGA_SEGUNDOS)
+    if catalogo is not None and catalogo.versao == versao and not expirado:
+        return catalogo
+    
+    cur.execute("SELECT projeto, peca, l1, l3, l3_b, pecas_especiais FROM public.pu_camadas")
+    catalogo = LayerCatalog(cur.fetchall(), versao)
+    with _catalogo_camadas_lock:
+        _catalogo_camadas_cache['catalogo'] = catalogo
+        _catalogo_camadas_cache['carregado_em'] = time.monotonic()
+    print(f"DEBUG: Catálogo de camadas recarregado (versão {versao}): {len(catalogo)} peças")
+    return catalogo
+
+class EstrategiaHorizontal:
+    """Primeiro local livre na ordem de preenchimento horizontal (E1, F1, G1...)"""
+    
+    nome = 'horizontal'
+    chave_grupo = None
+    
+    def pontuar(self, alocador, tipo_peca, op=None, lote=None):
+        return alocador.posicao
+
+
+class EstrategiaAgrupada:
+    """Local livre mais próximo (na sequência) das peças da mesma OP ou do mesmo lote
+    
+    Sem nenhuma peça do grupo nos racks, cai na ordem horizontal.
+    """
+    
+    def __init__(self, chave_grupo):
+        self.chave_grupo = chave_grupo
+        self.nome = f'agrupar_{chave_grupo}'
+    
+    def pontuar(self, alocador, tipo_peca, op=None, lote=None):
+        valor = op if self.chave_grupo == 'op' else lote
+        ancoras = alocador.grupos.get((self.chave_grupo, valor)) if valor else None
+        if not ancoras:
+            return alocador.posicao
+        
+        ancoras = np.sort(np.fromiter(ancoras, dtype=float))
+        posicao = alocador.posicao
+        j = np.searchsorted(ancoras, posicao)
+        esquerda = ancoras[np.clip(j - 1, 0, len(ancoras) - 1)]
+        direita = ancoras[np.clip(j, 0, len(ancoras) - 1)]
+        distancia = np.minimum(np.abs(posicao - esquerda), np.abs(posicao - direita))
+        # Desempate pela ordem horizontal (a fração nunca passa de 1)
+        return distancia + posicao / (len(posicao) + 1)
+
+
+class EstrategiaPertoCorte:
+    """Locais mais perto da estação de corte primeiro (distância em colunas + números)"""
+    
+    nome = 'perto_corte'
+    chave_grupo = None
+    
+    def __init__(self, local_estacao=None):
+        self.local_estacao = local_estacao or os.getenv('ESTACAO_CORTE_LOCAL', 'E1')
+    
+    def pontuar(self, alocador, tipo_peca, op=None, lote=None):
+        letra, num = RackTopology.decompor_local(self.local_estacao) or (RackTopology.LETRA_INICIAL, 1)
+        coordenadas = alocador.coordenadas
+        distancia = np.abs(coordenadas[:, 0] - (ord(letra) - ord('A'))) + np.abs(coordenadas[:, 1] - num)
+        return distancia + alocador.posicao / (len(alocador.posicao) + 1)
+
+
+ESTRATEGIAS_ALOCACAO = {
+    estrategia.nome: estrategia
+    for estrategia in (EstrategiaHorizontal(), EstrategiaAgrupada('op'), EstrategiaAgrupada('lote'), EstrategiaPertoCorte())
+}
+
+def obter_estrategia_alocacao(nome):
+    """Estratégia pelo nome; nomes vazios ou desconhecidos usam a horizontal"""
+    return ESTRATEGIAS_ALOCACAO.get(nome or '', ESTRATEGIAS_ALOCACAO['horizontal'])
+
+class LocationAllocator:
+    """Distribui locais de armazenamento a partir de um único retrato da ocupação.
+    
+    Carrega uma vez os locais ocupados e o tipo de peça de cada local, e usa a sequência
+    de preenchimento já compilada pela RackTopology. Cada local entregue fica reservado
+    para as próximas peças da mesma requisição, sem novas consultas ao banco.
+    
+    A escolha do local é feita pela estratégia: ela pontua todos os locais da sequência de
+    uma vez (arrays NumPy) e o alocador fica com o local livre de menor pontuação.
+    """
+    
+    def __init__(self, sequencia, pecas_por_local, locais_bloqueados=None, estrategia=None, grupos_por_local=None):
+        self.sequencia = sequencia
+        self.pecas_por_local = pecas_por_local
+        self.bloqueados = set(pecas_por_local) | set(locais_bloqueados or ())
+        self.estrategia = estrategia or ESTRATEGIAS_ALOCACAO['horizontal']
+        self.indice = {local: i for i, (local, _) in enumerate(sequencia)}
+        
+        # Todo local com peça já está bloqueado, então a regra de não misturar tipos se
+        # resume à máscara de locais livres
+        self.livres = np.fromiter((local not in self.bloqueados for local, _ in sequencia), dtype=bool, count=len(sequencia))
+        self.posicao = np.arange(len(sequencia), dtype=float)
+        coordenadas = [RackTopology.decompor_local(local) for local, _ in sequencia]
+        self.coordenadas = np.array([(ord(letra) - ord('A'), num) for letra, num in coordenadas], dtype=float).reshape(-1, 2)
+        
+        # Posições (na sequência) ocupadas por cada ('op', OP) / ('lote', lote), para as estratégias agrupadas
+        self.grupos = {}
+        for local, valor in (grupos_por_local or ()):
+            if local in self.indice and valor:
+                self.grupos.setdefault((self.estrategia.chave_grupo, valor), set()).add(self.indice[local])
+    
+    @classmethod
+    def carregar(cls, conn, locais_bloqueados=None, estrategia=None):
+        """Lê a ocupação em uma consulta e devolve o alocador pronto"""
+        cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        estrategia = estrategia or ESTRATEGIAS_ALOCACAO['horizontal']
+        
+        # Locais ocupados com o tipo de peça de cada um (índice mantido por gatilhos)
+        cur.execute("SELECT local, peca FROM public.pu_local_tipos")
+        pecas_por_local = {}
+        for row in cur.fetchall():
+            pecas_por_local.setdefault(row['local'], set()).add(row['peca'])
+        
+        # Locais sugeridos a outros operadores (reservas ainda no prazo) também ficam de fora
+        cur.execute("SELECT local FROM public.pu_reservas_locais WHERE expira_em > CURRENT_TIMESTAMP")
+        locais_bloqueados = set(locais_bloqueados or ()) | {row['local'] for row in cur.fetchall()}
+        
+        # OP / lote de cada local ocupado, só quando a estratégia agrupa peças
+        grupos_por_local = []
+        if estrategia.chave_grupo:
+            coluna = 'op' if estrategia.chave_grupo == 'op' else 'lote_vd'
+            cur.execute(f"""
+                SELECT local, {coluna} FROM public.pu_inventory WHERE local IS NOT NULL AND local != ''
+                UNION
+                SELECT local, {coluna} FROM public.pu_otimizadas WHERE tipo = 'PU' AND local IS NOT NULL AND local != ''
+                UNION
+                SELECT local, {coluna} FROM public.pu_manuais WHERE local IS NOT NULL AND local != ''
+            """)
+            grupos_por_local = [(row[0], row[1]) for row in cur.fetchall()]
         
-        # Buscar locais ativos no banco
-        cur.execute("SELECT local, nome FROM public.pu_locais WHERE status = 'Ativo' ORDER BY local")
-        locais_ativos = cur.fetchall()
+        # Sequência de preenchimento compilada (só relê pu_locais quando o layout muda)
+        topologia = obter_topologia_racks(conn)
         
-        if not locais_ativos:
+        if not topologia.sequencia:
             print("DEBUG: Nenhum local ativo encontrado")
+        
+        alocador = cls(topologia.sequencia, pecas_por_local, locais_bloqueados, estrategia, grupos_por_local)
+        print(f"DEBUG: Alocador carregado ({estrategia.nome}) - {len(topologia.sequencia)} locais na sequência, {len(pecas_por_local)} ocupados, {len(alocador.bloqueados)} bloqueados")
+        return alocador
+    
+    def sugerir(self, tipo_peca, op=None, lote=None):
+        """Retorna (local, rack) do livre de menor pontuação na estratégia, sem reservar"""
+        if not self.sequencia:
+            return None, None
+        pontos = np.where(self.livres, self.estrategia.pontuar(self, tipo_peca, op, lote), np.inf)
+        i = int(np.argmin(pontos))
+        if not np.isfinite(pontos[i]):
             return None, None
+        return self.sequencia[i]
+    
+    def reservar(self, local, tipo_peca=None, op=None, lote=None):
+        """Marca o local como usado nesta requisição"""
+        self.bloqueados.add(local)
+        if tipo_peca:
+            self.pecas_por_local.setdefault(local, set()).add(tipo_peca)
+        i = self.indice.get(local)
+        if i is not None:
+            self.livres[i] = False
+            for chave, valor in (('op', op), ('lote', lote)):
+                if valor:
+                    self.grupos.setdefault((chave, valor), set()).add(i)
+    
+    def alocar(self, tipo_peca, op=None, lote=None):
+        """Sugere e já reserva o próximo local disponível para a peça"""
+        local, rack = self.sugerir(tipo_peca, op, lote)
+        if local:
+            self.reservar(local, tipo_peca, op, lote)
+        return local, rack
+
+def sugerir_local_armazenamento(tipo_peca, locais_ocupados, conn):
+    """Sugere local de armazenamento preenchendo horizontalmente E1, F1, G1..."""
+    
+    try:
+        alocador = LocationAllocator.carregar(conn, locais_ocupados)
+        local, rack = alocador.sugerir(tipo_peca)
         
-        # Buscar locais que já têm peças diferentes do tipo atual (não podem misturar tipos)
-        cur.execute("""
-            SELECT DISTINCT local FROM (
-                SELECT local FROM public.pu_inventory WHERE peca != %s AND local IS NOT NULL AND local != ''
-                UNION ALL
-                SELECT local FROM public.pu_otimizadas WHERE peca != %s AND tipo = 'PU' AND local IS NOT NULL AND local != ''
-                UNION ALL
-                SELECT local FROM public.pu_manuais WHERE peca != %s AND local IS NOT NULL AND local != ''
-            ) AS different_pieces
-        """, (tipo_peca, tipo_peca, tipo_peca))
-        locais_com_pecas_diferentes = {row['local'] for row in cur.fetchall()}
+        if local:
+            print(f"DEBUG: Local {local} disponível encontrado")
+        else:
+            # Se não encontrou nenhum disponível, retornar None para indicar erro
+            print(f"DEBUG: Nenhum local disponível encontrado")
+        return local, rack
         
-        # Criar mapeamento de locais por rack
-        locais_por_rack = {}
-        for local_info in locais_ativos:
-            local = local_info['local']
-            rack = local_info['nome']
-            if rack not in locais_por_rack:
-                locais_por_rack[rack] = []
-            locais_por_rack[rack].append(local)
-        
-        # Ordenar locais por número para cada rack
-        for rack in locais_por_rack:
-            locais_por_rack[rack].sort(key=lambda x: (int(''.join(filter(str.isdigit, x))), x[0]))
-        
-        # Sequência de preenchimento horizontal: E1, F1, G1... depois E2, F2, G2...
-        def gerar_sequencia_horizontal():
-            sequencia = []
-            
-            # Determinar range de números para cada rack
-            ranges_rack = {
-                'RACK1': range(1, 29),
-                'RACK2': range(29, 57), 
-                'RACK3': range(57, 85)
-            }
+    except Exception as e:
+        print(f"DEBUG: Erro na sugestão de local: {e}")
+        import traceback
+        traceback.print_exc()
+        return None, None
+
+def alocar_locais_lote(conn, pecas, locais_bloqueados=None, estrategia=None, lote=None):
+    """Aloca locais para uma lista de (op, peca, projeto) a partir de um único retrato do banco
+    
+    estrategia é o nome de uma entrada de ESTRATEGIAS_ALOCACAO (padrão: horizontal); lote é
+    usado pela estratégia que agrupa as peças do mesmo lote.
+    
+    Retorna (alocacoes, sem_local): alocacoes segue a ordem recebida e usa "SEM LOCAL"/"N/A"
+    para as peças que não couberam; sem_local lista apenas essas peças.
+    """
+    alocador = LocationAllocator.carregar(conn, locais_bloqueados, obter_estrategia_alocacao(estrategia))
+    
+    alocacoes = []
+    sem_local = []
+    for op, peca, projeto in pecas:
+        local, rack = alocador.alocar(peca, op, lote)
+        item = {'op': op, 'peca': peca, 'projeto': projeto, 'local': local, 'rack': rack}
+        if not local or not rack:
+            item['local'] = 'SEM LOCAL'
+            item['rack'] = 'N/A'
+            sem_local.append(item)
+        alocacoes.append(item)
+    
+    print(f"DEBUG: Alocação em lote - {len(alocacoes) - len(sem_local)} peça(s) com local, {len(sem_local)} sem local")
+    return alocacoes, sem_local
+
+# Condição "a peça p (op, peca) já está no estoque ou nas otimizadas (PU)"
+PECA_GRAVADA_SQL = """(
+    EXISTS (SELECT 1 FROM public.pu_inventory i WHERE i.op = p.op AND i.peca = p.peca)
+    OR EXISTS (SELECT 1 FROM public.pu_otimizadas o WHERE o.op = p.op AND o.peca = p.peca AND o.tipo = 'PU')
+)"""
+
+# Condição "a peça p (op, peca) já está no estoque, nas otimizadas (PU) ou nas manuais"
+PECA_JA_EXISTE_SQL = f"""(
+    {PECA_GRAVADA_SQL}
+    OR EXISTS (SELECT 1 FROM public.pu_manuais m WHERE m.op = p.op AND m.peca = p.peca)
+)"""
+
+def pecas_ja_existentes(cur, pares, incluir_manuais=True):
+    """Pares (op, peca) que já estão no estoque, nas otimizadas (PU) ou nas manuais
+    
+    Com incluir_manuais=False, pu_manuais não é consultada (a otimização grava justamente as
+    peças que estão lá). Todos os pares vão em uma única consulta (arrays + unnest), em vez
+    de uma por peça.
+    """
+    pares = list(pares)
+    if not pares:
+        return set()
+    condicao = PECA_JA_EXISTE_SQL if incluir_manuais else PECA_GRAVADA_SQL
+    cur.execute(f"""
+        SELECT p.op, p.peca
+        FROM unnest(%s::text[], %s::text[]) AS p(op, peca)
+        WHERE {condicao}
+    """, ([op for op, _ in pares], [peca for _, peca in pares]))
+    return {(row[0], row[1]) for row in cur.fetchall()}
+
+def resolver_lotes(cur, pares):
+    """Lotes VD e PU de cada par (op, peca) em public.plano_controle_corte_vidro2
+
+    Todos os pares vão em uma única consulta (arrays + unnest), que já deriva o lote PU
+    ('PU' + lote_vd[2:]). Retorna {(op, peca): (lote_vd, lote_pu)}; pares sem lote no
+    plano ficam de fora do dicionário.
+    """
+    pares = list(dict.fromkeys(pares))
+    if not pares:
+        return {}
+    cur.execute("""
+        SELECT DISTINCT ON (p.op, p.peca) p.op, p.peca, c.id_lote,
+               CASE WHEN length(c.id_lote) >= 3 THEN 'PU' || substr(c.id_lote, 3) ELSE c.id_lote END
+        FROM unnest(%s::text[], %s::text[]) AS p(op, peca)
+        JOIN public.plano_controle_corte_vidro2 c ON c.op = p.op AND c.peca = p.peca
+        WHERE c.id_lote IS NOT NULL AND c.id_lote <> ''
+        ORDER BY p.op, p.peca
+    """, ([op for op, _ in pares], [peca for _, peca in pares]))
+    return {(row[0], row[1]): (row[2], row[3]) for row in cur.fetchall()}
+
+def _locais_ocupados_entre(cur, locais):
+    """Subconjunto de locais que já têm peça no estoque ou nas otimizadas"""
+    cur.execute("""
+        SELECT local FROM public.pu_ocupacao
+        WHERE local = ANY(%s) AND estoque + otimizadas > 0
+    """, (list(locais),))
+    return {row[0] for row in cur.fetchall()}
+
+def reservar_locais(conn, pecas):
+    """Trava em public.pu_locais os locais escolhidos até o commit da transação
+
+    Os locais são travados com SELECT ... FOR UPDATE em ordem alfabética (sem deadlock entre
+    operadores): quem escolheu o mesmo local espera o commit do outro e só então confere a
+    ocupação. Peças cujo local já foi ocupado recebem o próximo local livre da sequência,
+    travado com FOR UPDATE SKIP LOCKED para não disputar com outra otimização em andamento.
+    Quem chama já recusou as peças que estão gravadas (pecas_ja_existentes), então o ocupante
+    de um local em conflito é sempre outra (op, peça).
+
+    Atualiza 'local'/'rack' das peças realocadas e retorna (realocadas, sem_local).
+    """
+    cur = conn.cursor()
+    locais = sorted({p.get('local') for p in pecas if p.get('local') and p.get('local') != 'SEM LOCAL'})
+    if not locais:
+        return [], []
+
+    # Trava e conferência em uma única ida ao banco: as duas instruções vão no mesmo envio, e
+    # a consulta de ocupação roda depois da trava com um retrato novo (READ COMMITTED), então
+    # enxerga o que a otimização que segurava algum desses locais gravou antes do commit dela
+    cur.execute("""
+        SELECT local FROM public.pu_locais
+        WHERE local = ANY(%(locais)s)
+        ORDER BY local
+        FOR UPDATE;
+        SELECT local FROM public.pu_ocupacao
+        WHERE local = ANY(%(locais)s) AND estoque + otimizadas > 0
+    """, {'locais': locais})
+    ocupados = {row[0] for row in cur.fetchall()}
+    conflitos = [p for p in pecas if p.get('local') in ocupados]
+    if not conflitos:
+        return [], []
+
+    print(f"DEBUG: {len(conflitos)} local(is) ocupado(s) por outro usuário, realocando...")
+    # Os locais da própria seleção continuam bloqueados para as peças realocadas
+    alocador = LocationAllocator.carregar(conn, locais)
+
+    realocadas = []
+    sem_local = []
+    for peca in conflitos:
+        while True:
+            local, rack = alocador.alocar(peca.get('peca', ''))
+            if not local:
+                break
+            cur.execute("""
+                SELECT local FROM public.pu_locais
+                WHERE local = %s AND status = 'Ativo'
+                FOR UPDATE SKIP LOCKED
+            """, (local,))
+            # Travado por outra otimização ou ocupado depois do retrato do alocador: tentar o próximo
+            if cur.fetchone() and not _locais_ocupados_entre(cur, [local]):
+                break
+
+        if not local:
+            sem_local.append(peca)
+            continue
+
+        realocadas.append({'op': peca.get('op', ''), 'peca': peca.get('peca', ''), 'de': peca.get('local'), 'para': local})
+        peca['local'] = local
+        peca['rack'] = rack
+
+    return realocadas, sem_local
+
+def prever_locais(conn, pecas):
+    """Como reservar_locais, mas sem travar nada: para a prévia (dry_run) da otimização
+
+    Peças cujo local já está ocupado recebem o local que o alocador escolheria agora; a
+    otimização de verdade confere de novo com as travas. Retorna (realocadas, sem_local).
+    """
+    cur = conn.cursor()
+    locais = sorted({p.get('local') for p in pecas if p.get('local') and p.get('local') != 'SEM LOCAL'})
+    if not locais:
+        return [], []
+
+    ocupados = _locais_ocupados_entre(cur, locais)
+    conflitos = [p for p in pecas if p.get('local') in ocupados]
+    if not conflitos:
+        return [], []
+
+    alocador = LocationAllocator.carregar(conn, locais)
+    realocadas = []
+    sem_local = []
+    for peca in conflitos:
+        local, rack = alocador.alocar(peca.get('peca', ''))
+        if not local:
+            sem_local.append(peca)
+            continue
+        realocadas.append({'op': peca.get('op', ''), 'peca': peca.get('peca', ''), 'de': peca.get('local'), 'para': local})
+        peca['local'] = local
+        peca['rack'] = rack
+
+    return realocadas, sem_local
+
+def alocar_locais_reservados(conn, usuario, lote, pecas, locais_bloqueados=None, estrategia=None):
+    """Como alocar_locais_lote, mas guarda as sugestões em public.pu_reservas_locais
+
+    Cada local sugerido fica reservado para (usuario, lote) por RESERVA_LOCAL_TTL_MINUTOS.
+    Ao atualizar a tela, a peça recebe de novo o local que já tinha reservado (se continuar
+    livre) e só as peças sem reserva passam pelo alocador, que ignora as reservas dos
+    outros operadores. A reserva é gravada com ON CONFLICT (local) DO NOTHING: se outro
+    operador pegou o mesmo local no mesmo instante, a peça vai para o próximo da sequência.
+    Trocar de estratégia descarta as reservas feitas com a anterior. Faz commit das reservas.
+    """
+    estrategia = obter_estrategia_alocacao(estrategia)
+    cur = conn.cursor()
+    cur.execute("DELETE FROM public.pu_reservas_locais WHERE expira_em <= CURRENT_TIMESTAMP")
+    
+    cur.execute("""
+        SELECT op, peca, local, rack, estrategia FROM public.pu_reservas_locais
+        WHERE usuario = %s AND lote = %s
+    """, (usuario, lote))
+    reservas = {}
+    estrategias_reservadas = {}
+    for op, peca, local, rack, estrategia_reserva in cur.fetchall():
+        reservas[(op, peca)] = (local, rack)
+        estrategias_reservadas[(op, peca)] = estrategia_reserva
+    
+    # Reservas de peças que saíram do lote, feitas com outra estratégia ou cujo local foi
+    # ocupado nesse meio tempo caem
+    pendentes = {(op, peca) for op, peca, _ in pecas}
+    ocupados = set(locais_bloqueados or ())
+    if reservas:
+        cur.execute("SELECT local FROM public.pu_ocupacao WHERE local = ANY(%s)", ([local for local, _ in reservas.values()],))
+        ocupados |= {row[0] for row in cur.fetchall()}
+    validas = {
+        chave: reserva for chave, reserva in reservas.items()
+        if chave in pendentes and reserva[0] not in ocupados
+        and (estrategias_reservadas[chave] or 'horizontal') == estrategia.nome
+    }
+    descartadas = [local for chave, (local, _) in reservas.items() if chave not in validas]
+    if descartadas:
+        cur.execute("""
+            DELETE FROM public.pu_reservas_locais
+            WHERE usuario = %s AND lote = %s AND local = ANY(%s)
+        """, (usuario, lote, descartadas))
+    
+    alocacoes = []
+    faltando = []
+    for i, (op, peca, projeto) in enumerate(pecas):
+        local, rack = validas.get((op, peca), (None, None))
+        alocacoes.append({'op': op, 'peca': peca, 'projeto': projeto, 'local': local, 'rack': rack})
+        if not local:
+            faltando.append(i)
+    
+    if faltando:
+        # As reservas válidas deste usuário já entram como bloqueadas pelo próprio alocador
+        alocador = LocationAllocator.carregar(conn, locais_bloqueados, estrategia)
+        while faltando:
+            propostas = []
+            for i in faltando:
+                local, rack = alocador.alocar(alocacoes[i]['peca'], alocacoes[i]['op'], lote)
+                if local:
+                    propostas.append((i, local, rack))
+            if not propostas:
+                break
             
-            # Para cada rack
-            for rack_name in ['RACK1', 'RACK2', 'RACK3']:
-                if rack_name not in locais_por_rack:
-                    continue
-                    
-                num_range = ranges_rack[rack_name]
-                
-                # Primeiro preencher todas as colunas E até M
-                for num in num_range:
-                    for letra_code in range(ord('E'), ord('M') + 1):
-                        letra = chr(letra_code)
-                        local = f"{letra}{num}"
-                        
-                        if local in locais_por_rack[rack_name]:
-                            sequencia.append((local, 'COLMEIA'))
-                
-                # Depois preencher D até A (só depois de terminar E-M)
-                for num in num_range:
-                    for letra_code in range(ord('D'), ord('A') - 1, -1):
-                        letra = chr(letra_code)
-                        local = f"{letra}{num}"
-                        
-                        if local in locais_por_rack[rack_name]:
-                            sequencia.append((local, 'COLMEIA'))
+            ganhos = {row[0] for row in psycopg2.extras.execute_values(cur, """
+                INSERT INTO public.pu_reservas_locais (local, rack, usuario, lote, op, peca, estrategia, expira_em)
+                VALUES %s
+                ON CONFLICT (local) DO NOTHING
+                RETURNING local
+            """, [
+                (local, rack, usuario, lote, alocacoes[i]['op'], alocacoes[i]['peca'], estrategia.nome, RESERVA_LOCAL_TTL_MINUTOS)
+                for i, local, rack in propostas
+            ], template="(%s, %s, %s, %s, %s, %s, %s, CURRENT_TIMESTAMP + %s * INTERVAL '1 minute')", fetch=True)}
             
-            return sequencia
-        
-        sequencia_completa = gerar_sequencia_horizontal()
+            faltando = []
+            for i, local, rack in propostas:
+                if local in ganhos:
+                    alocacoes[i]['local'] = local
+                    alocacoes[i]['rack'] = rack
+                else:
+                    faltando.append(i)
+    
+    # Renovar o prazo das reservas que continuam na tela
+    cur.execute("""
+        UPDATE public.pu_reservas_locais
+        SET expira_em = CURRENT_TIMESTAMP + %s * INTERVAL '1 minute'
+        WHERE usuario = %s AND lote = %s
+    """, (RESERVA_LOCAL_TTL_MINUTOS, usuario, lote))
+    conn.commit()
+    
+    sem_local = []
+    for item in alocacoes:
+        if not item['local'] or not item['rack']:
+            item['local'] = 'SEM LOCAL'
+            item['rack'] = 'N/A'
+            sem_local.append(item)
+    
+    print(f"DEBUG: Reservas {usuario}/{lote} ({estrategia.nome}) - {len(validas)} reaproveitada(s), {len(alocacoes) - len(validas) - len(sem_local)} nova(s), {len(sem_local)} sem local")
+    return alocacoes, sem_local
+
+@app.route('/api/alocar-locais', methods=['POST'])
+@login_required
+def alocar_locais():
+    """Sugere locais para várias peças de uma vez, sem gravar nada"""
+    try:
+        dados = request.get_json()
+        pecas = dados.get('pecas', [])
         
-        # Combinar TODOS os locais bloqueados
-        locais_bloqueados = todos_locais_ocupados | locais_com_pecas_diferentes
+        if not pecas:
+            return jsonify({'success': False, 'message': 'Nenhuma peça informada'})
         
-        print(f"DEBUG: Total de locais ativos: {len(locais_ativos)}")
-        print(f"DEBUG: Locais ocupados no DB: {len(locais_ocupados_db)}")
-        print(f"DEBUG: Locais ocupados parâmetro: {len(locais_ocupados)}")
-        print(f"DEBUG: Locais com peças diferentes: {len(locais_com_pecas_diferentes)}")
-        print(f"DEBUG: Total de locais bloqueados: {len(locais_bloqueados)}")
+        pecas_lote = [
+            (str(p.get('op', '')).strip(), str(p.get('peca', '')).strip(), str(p.get('projeto', '')).strip())
+            for p in pecas
+        ]
         
-        # Buscar primeiro local disponível
-        for local, rack in sequencia_completa:
-            if local not in locais_bloqueados:
-                print(f"DEBUG: Local {local} disponível encontrado")
-                return local, rack
+        conn = get_db_connection()
+        alocacoes, sem_local = alocar_locais_lote(
+            conn,
+            pecas_lote,
+            set(dados.get('locais_bloqueados', [])),
+            dados.get('estrategia', ''),
+            dados.get('lote') or None
+        )
+        conn.close()
         
-        # Se não encontrou nenhum disponível, retornar None para indicar erro
-        print(f"DEBUG: Nenhum local disponível encontrado")
-        return None, None
+        return jsonify({
+            'success': True,
+            'alocacoes': alocacoes,
+            'sem_local': sem_local
+        })
         
     except Exception as e:
-        print(f"DEBUG: Erro na sugestão de local: {e}")
-        import traceback
-        traceback.print_exc()
-        return None, None
+        return jsonify({'success': False, 'message': f'Erro: {str(e)}'}), 500
 
 @app.route('/api/adicionar-peca-manual', methods=['POST'])
 @login_required
@@ -863,18 +1481,11 @@ def adicionar_peca_manual():
         conn = get_db_connection()
         cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
         
-        cur.execute("SELECT COUNT(*) FROM public.pu_inventory WHERE op = %s AND peca = %s", (op, peca))
-        existe_estoque = cur.fetchone()[0] > 0
-        
-        cur.execute("SELECT COUNT(*) FROM public.pu_otimizadas WHERE op = %s AND peca = %s AND tipo = 'PU'", (op, peca))
-        existe_otimizadas = cur.fetchone()[0] > 0
-        
-        cur.execute("SELECT COUNT(*) FROM public.pu_manuais WHERE op = %s AND peca = %s", (op, peca))
-        existe_manuais = cur.fetchone()[0] > 0
+        existe = bool(pecas_ja_existentes(cur, [(op, peca)]))
         
         conn.close()
         
-        if existe_estoque or existe_otimizadas or existe_manuais:
+        if existe:
             return jsonify({'success': False, 'message': f'Peça {peca} com OP {op} já existe no sistema'})
     
     except Exception as e:
@@ -900,40 +1511,6 @@ def adicionar_peca_manual():
             )
         """)
         
-        # Buscar TODOS os locais ocupados (incluindo manuais)
-        cur.execute("""
-            SELECT local FROM public.pu_inventory WHERE local IS NOT NULL AND local != '' 
-            UNION 
-            SELECT local FROM public.pu_otimizadas WHERE tipo = 'PU' AND local IS NOT NULL AND local != ''
-            UNION
-            SELECT local FROM public.pu_manuais WHERE local IS NOT NULL AND local != ''
-        """)
-        locais_ocupados = {row['local'] for row in cur.fetchall()}
-        
-        # Buscar locais que já têm peças diferentes do tipo atual
-        cur.execute("""
-            SELECT DISTINCT local FROM public.pu_inventory 
-            WHERE peca != %s AND local IS NOT NULL AND local != ''
-            UNION
-            SELECT DISTINCT local FROM public.pu_otimizadas 
-            WHERE peca != %s AND tipo = 'PU' AND local IS NOT NULL AND local != ''
-            UNION
-            SELECT DISTINCT local FROM public.pu_manuais 
-            WHERE peca != %s AND local IS NOT NULL AND local != ''
-        """, (peca, peca, peca))
-        locais_com_pecas_diferentes = {row['local'] for row in cur.fetchall()}
-        
-        # Buscar locais já usados em peças manuais desta sessão para evitar duplicatas
-        cur.execute("""
-            SELECT DISTINCT local FROM public.pu_manuais 
-            WHERE usuario = %s AND DATE(data_criacao) = CURRENT_DATE
-            AND local IS NOT NULL AND local != ''
-        """, (current_user.username,))
-        locais_sessao_atual = {row['local'] for row in cur.fetchall()}
-        
-        # Combinar todos os locais bloqueados + locais da sessão atual
-        locais_bloqueados = locais_ocupados | locais_com_pecas_diferentes | locais_sessao_atual
-        
         # Buscar arquivo baseado no projeto, peça e sensor
         arquivo_status = "Sem arquivo"
         if peca == 'PBS' and sensor:
@@ -956,28 +1533,21 @@ def adicionar_peca_manual():
             if arquivo_result:
                 arquivo_status = arquivo_result['nome_peca']
         
-        # Sugerir local (passando locais bloqueados)
-        local_sugerido, rack_sugerido = sugerir_local_armazenamento(peca, locais_bloqueados, conn)
+        # Sugerir local (a ocupação carregada já inclui as peças manuais desta sessão)
+        alocacoes, sem_local = alocar_locais_lote(conn, [(op, peca, projeto)])
         
         # Verificar se conseguiu sugerir um local válido
-        if not local_sugerido or not rack_sugerido:
+        if sem_local:
             conn.close()
             return jsonify({'success': False, 'message': 'Não há locais disponíveis para esta peça'}), 400
         
+        local_sugerido = alocacoes[0]['local']
+        rack_sugerido = alocacoes[0]['rack']
+        
 
         
         # Buscar lote da peça na tabela plano_controle_corte_vidro2
-        lote_vd = ''
-        lote_pu = ''
-        cur.execute("""
-            SELECT id_lote FROM public.plano_controle_corte_vidro2
-            WHERE op = %s AND peca = %s
-            LIMIT 1
-        """, (op, peca))
-        lote_result = cur.fetchone()
-        if lote_result and lote_result['id_lote']:
-            lote_vd = lote_result['id_lote']
-            lote_pu = 'PU' + lote_vd[2:] if len(lote_vd) >= 2 else lote_vd
+        lote_vd, lote_pu = resolver_lotes(cur, [(op, peca)]).get((op, peca), ('', ''))
         
         # Adicionar colunas lote_vd, lote_pu e sensor se não existirem na tabela pu_manuais
         try:
@@ -1133,7 +1703,7 @@ def api_dados():
         pecas_manuais = cur.fetchall()
         
         # Buscar TODOS os locais ocupados (incluindo os já otimizados)
-        cur.execute("SELECT local FROM public.pu_inventory WHERE local IS NOT NULL AND local != '' UNION SELECT local FROM public.pu_otimizadas WHERE tipo = 'PU' AND local IS NOT NULL AND local != ''")
+        cur.execute("SELECT local FROM public.pu_ocupacao WHERE estoque + otimizadas > 0")
         locais_ocupados_fixos = {row['local'] for row in cur.fetchall()}
         
         # Verificar se há locais disponíveis
@@ -1181,77 +1751,76 @@ def api_dados():
         
         # Processar dados do banco
         dados_filtrados = []
-        locais_usados_nesta_sessao = set()
+        pecas_pendentes = [row for row in dados_banco if f"{row['op']}_{row['peca']}" not in pecas_existentes]
+        
+        # Alocar locais de todas as peças pendentes de uma vez (peças sem local ficam com "SEM LOCAL").
+        # Usuário logado reaproveita os locais já reservados para ele e o lote; sem login as
+        # sugestões não são reservadas (o IP não identifica o operador e ninguém deve conseguir
+        # reservar o rack sem autenticação)
+        pecas_alocar = [(row['op'], row['peca'], row['projeto']) for row in pecas_pendentes]
+        if current_user.is_authenticated:
+            alocacoes, sem_local = alocar_locais_reservados(
+                conn,
+                current_user.username,
+                lote,
+                pecas_alocar,
+                locais_ocupados_fixos,
+                request.args.get('estrategia', '')
+            )
+        else:
+            alocacoes, sem_local = alocar_locais_lote(
+                conn,
+                pecas_alocar,
+                locais_ocupados_fixos,
+                request.args.get('estrategia', ''),
+                lote
+            )
         
-        for row in dados_banco:
+        for row, alocacao in zip(pecas_pendentes, alocacoes):
             try:
-                chave_peca = f"{row['op']}_{row['peca']}"
-                if chave_peca not in pecas_existentes:
-                    # Combinar locais ocupados com os já usados nesta sessão
-                    locais_bloqueados = locais_ocupados_fixos | locais_usados_nesta_sessao
-                    
-                    # Aplicar lógica de sugestão
-                    local_sugerido, rack_sugerido = sugerir_local_armazenamento(row['peca'], locais_bloqueados, conn)
-                    
-                    # Se não conseguiu sugerir local, usar "SEM LOCAL"
-                    if not local_sugerido or not rack_sugerido:
-                        local_sugerido = "SEM LOCAL"
-                        rack_sugerido = "N/A"
-                        print(f"DEBUG: Não foi possível sugerir local para peça {row['peca']}, usando SEM LOCAL")
-                    elif local_sugerido in locais_usados_nesta_sessao:
-                        # Se o local já foi usado nesta sessão, tentar sugerir outro
-                        locais_bloqueados_com_sessao = locais_bloqueados | locais_usados_nesta_sessao
-                        local_sugerido, rack_sugerido = sugerir_local_armazenamento(row['peca'], locais_bloqueados_com_sessao, conn)
-                        if not local_sugerido or not rack_sugerido:
-                            local_sugerido = "SEM LOCAL"
-                            rack_sugerido = "N/A"
-                            print(f"DEBUG: Não foi possível sugerir local alternativo para peça {row['peca']}, usando SEM LOCAL")
-                    
-                    # Buscar arquivo baseado no projeto e peça
-                    arquivo_status = 'Sem arquivo de corte'
-                    
+                local_sugerido = alocacao['local']
+                rack_sugerido = alocacao['rack']
+                
+                # Buscar arquivo baseado no projeto e peça
+                arquivo_status = 'Sem arquivo de corte'
+                
+                cur.execute("""
+                    SELECT nome_peca FROM public.arquivos_pu
+                    WHERE projeto = %s AND peca = %s
+                    LIMIT 1
+                """, (str(row['projeto']) if row['projeto'] else '', row['peca']))
+                arquivo_result = cur.fetchone()
+                if arquivo_result:
+                    arquivo_status = arquivo_result['nome_peca']
+                
+                # Usar veículo diretamente da tabela plano_controle_corte_vidro2
+                veiculo = str(row.get('veiculo', '') or '').strip()
+                
+                # Buscar sensor se a peça for PBS
+                sensor = ''
+                if str(row['peca']) == 'PBS':
                     cur.execute("""
-                        SELECT nome_peca FROM public.arquivos_pu
+                        SELECT sensor FROM public.arquivos_pu
                         WHERE projeto = %s AND peca = %s
                         LIMIT 1
-                    """, (str(row['projeto']) if row['projeto'] else '', row['peca']))
-                    arquivo_result = cur.fetchone()
-                    if arquivo_result:
-                        arquivo_status = arquivo_result['nome_peca']
-                    
-                    # Usar veículo diretamente da tabela plano_controle_corte_vidro2
-                    veiculo = str(row.get('veiculo', '') or '').strip()
-                    
-                    # Buscar sensor se a peça for PBS
-                    sensor = ''
-                    if str(row['peca']) == 'PBS':
-                        cur.execute("""
-                            SELECT sensor FROM public.arquivos_pu
-                            WHERE projeto = %s AND peca = %s
-                            LIMIT 1
-                        """, (str(row['projeto']) if row['projeto'] else '', str(row['peca'])))
-                        sensor_result = cur.fetchone()
-                        if sensor_result:
-                            sensor = sensor_result['sensor'] or ''
-                    
-                    item = {
-                        'op_pai': '0',
-                        'op': str(row['op']) if row['op'] else '',
-                        'peca': str(row['peca']) if row['peca'] else '',
-                        'projeto': str(row['projeto']) if row['projeto'] else '',
-                        'veiculo': veiculo,
-                        'local': local_sugerido or '',
-                        'rack': rack_sugerido or '',
-                        'data_criacao': datetime.now().isoformat(),
-                        'arquivo_status': arquivo_status,
-                        'sensor': sensor
-                    }
-                    
-                    # Adicionar o local aos usados nesta sessão (apenas se não for "SEM LOCAL")
-                    if local_sugerido and local_sugerido != "SEM LOCAL":
-                        locais_usados_nesta_sessao.add(local_sugerido)
-                        print(f"DEBUG: Local {local_sugerido} reservado para peça {row['peca']} OP {row['op']}")
-                    dados_filtrados.append(item)
+                    """, (str(row['projeto']) if row['projeto'] else '', str(row['peca'])))
+                    sensor_result = cur.fetchone()
+                    if sensor_result:
+                        sensor = sensor_result['sensor'] or ''
+                
+                item = {
+                    'op_pai': '0',
+                    'op': str(row['op']) if row['op'] else '',
+                    'peca': str(row['peca']) if row['peca'] else '',
+                    'projeto': str(row['projeto']) if row['projeto'] else '',
+                    'veiculo': veiculo,
+                    'local': local_sugerido or '',
+                    'rack': rack_sugerido or '',
+                    'data_criacao': datetime.now().isoformat(),
+                    'arquivo_status': arquivo_status,
+                    'sensor': sensor
+                }
+                dados_filtrados.append(item)
             except Exception as row_error:
                 print(f"DEBUG: Erro ao processar linha: {row_error}")
                 if conn:
@@ -1513,18 +2082,23 @@ def estoque_data():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-@app.route('/api/otimizar-pecas', methods=['POST'])
-@login_required
-def otimizar_pecas():
+def executar_otimizacao(dados, usuario, progresso=None):
+    """Otimiza as peças de `dados` (mesmo corpo de /api/otimizar-pecas) em uma única transação
+
+    `progresso(etapa, processadas, inseridas)` é chamado antes e depois de cada fase (travas,
+    reserva de locais, expansão das camadas e gravação), para os jobs em segundo plano. Com `dados['dry_run']`, faz a mesma expansão e conferência de
+    locais em um retrato somente leitura e devolve o plano sem gravar nada.
+    Retorna (resposta, status_http).
+    """
     conn = None
     try:
         print("DEBUG: Iniciando otimização")
-        dados = request.get_json()
         print(f"DEBUG: Dados recebidos: {dados}")
         
         pecas_selecionadas = dados.get('pecas', [])
         data_corte = dados.get('dataCorte', '')
         lote_selecionado = dados.get('lote', '')
+        dry_run = bool(dados.get('dry_run'))
         print(f"DEBUG: {len(pecas_selecionadas)} peças selecionadas, data de corte: {data_corte}, lote: {lote_selecionado}")
         
         # Processar lote PUAVULSA
@@ -1540,7 +2114,7 @@ def otimizar_pecas():
                 lote_final = 'PUAVULSA'
         
         if not pecas_selecionadas:
-            return jsonify({'success': False, 'message': 'Nenhuma peça selecionada'})
+            return {'success': False, 'message': 'Nenhuma peça selecionada'}, 200
         
         # Verificar se há peças sem local disponível PRIMEIRO
         pecas_sem_local = [peca for peca in pecas_selecionadas if peca.get('local') == 'SEM LOCAL']
@@ -1550,94 +2124,121 @@ def otimizar_pecas():
             if len(pecas_sem_local) > 3:
                 mensagem += f'\n• ... e mais {len(pecas_sem_local) - 3} peça(s)'
             mensagem += '\n\n🔧 Soluções:\n1. Remova peças do estoque para liberar locais\n2. Cadastre novos locais\n3. Atualize os dados e tente novamente'
-            return jsonify({
+            return {
                 'success': False, 
                 'message': mensagem
-            })
+            }, 200
         
         # Verificar se há locais duplicados nas peças selecionadas (excluindo "SEM LOCAL")
         locais_selecionados = [peca.get('local') for peca in pecas_selecionadas if peca.get('local') and peca.get('local') != 'SEM LOCAL']
         locais_duplicados = [local for local in set(locais_selecionados) if locais_selecionados.count(local) > 1]
         
         if locais_duplicados:
-            return jsonify({
+            return {
                 'success': False, 
                 'message': f'❌ ERRO: Locais duplicados detectados: {", ".join(locais_duplicados)}.\n\nCada local pode ter apenas uma peça. Atualize os dados e tente novamente.'
-            })
+            }, 200
         
         print("DEBUG: Conectando ao banco")
         conn = get_db_connection()
+        if dry_run:
+            # Prévia: retrato somente leitura do banco, sem travas e sem gravar nada
+            conn.set_session(isolation_level=psycopg2.extensions.ISOLATION_LEVEL_REPEATABLE_READ, readonly=True)
         cur = conn.cursor()
         
-        # Limpar tabela pu_manuais antes da verificação final para evitar conflitos
-        print("DEBUG: Limpando tabela pu_manuais antes da verificação final...")
-        cur.execute("DELETE FROM public.pu_manuais")
-        conn.commit()
+        catalogo_camadas = obter_catalogo_camadas(conn)
         
-        # Verificar novamente se todos os locais ainda estão disponíveis (verificação final crítica)
-        print("DEBUG: Verificando disponibilidade final dos locais...")
-        locais_conflito = []
-        for peca in pecas_selecionadas:
-            local = peca.get('local')
-            if local and local != 'SEM LOCAL':
-                cur.execute("""
-                    SELECT COUNT(*) FROM (
-                        SELECT local FROM public.pu_inventory WHERE local = %s
-                        UNION ALL
-                        SELECT local FROM public.pu_otimizadas WHERE local = %s AND tipo = 'PU'
-                    ) AS occupied
-                """, (local, local))
-                
-                if cur.fetchone()[0] > 0:
-                    locais_conflito.append(f"{local} (peça {peca.get('peca', 'N/A')} OP {peca.get('op', 'N/A')})")
+        # Pares (op, peça) que a otimização vai gravar: os selecionados e as peças especiais
+        pares_otimizacao = sorted(dict.fromkeys(
+            (peca.get('op', ''), peca_atual)
+            for peca in pecas_selecionadas
+            for peca_atual in [peca.get('peca', '')] + catalogo_camadas.pecas_para_processar(peca.get('projeto', ''), peca.get('peca', ''))
+        ))
         
-        if locais_conflito:
+        if progresso:
+            progresso('travando', 0, 0)
+        if not dry_run:
+            # Travar cada (op, peça) em ordem (sem deadlock): um reenvio ou outro operador com as
+            # mesmas peças espera o commit desta otimização e então as encontra já gravadas
+            print("DEBUG: Travando as peças e limpando as selecionadas de pu_manuais...")
+            cur.execute("""
+                SELECT pg_advisory_xact_lock(hashtext(s.op || '|' || s.peca))
+                FROM (
+                    SELECT p.op, p.peca
+                    FROM unnest(%s::text[], %s::text[]) AS p(op, peca)
+                    ORDER BY p.op, p.peca
+                ) s
+            """, ([op for op, _ in pares_otimizacao], [peca for _, peca in pares_otimizacao]))
+            
+            # Tirar de pu_manuais só as peças desta otimização, na mesma transação (se ela falhar,
+            # as peças manuais continuam lá). As demais linhas não ficam travadas, então a
+            # otimização de outro tablet não espera por esta
+            cur.execute("""
+                DELETE FROM public.pu_manuais m
+                USING unnest(%s::text[], %s::text[]) AS p(op, peca)
+                WHERE m.op = p.op AND m.peca = p.peca
+            """, ([op for op, _ in pares_otimizacao], [peca for _, peca in pares_otimizacao]))
+        
+        # Peças que já estão nas otimizadas (PU) ou no estoque não podem ser gravadas de novo. As
+        # manuais ficam de fora também na prévia, que não limpa pu_manuais: peças adicionadas à
+        # mão ou por planilha estão lá justamente para serem otimizadas
+        pecas_existentes = pecas_ja_existentes(cur, pares_otimizacao, incluir_manuais=False)
+        if pecas_existentes:
+            conn.rollback()
             conn.close()
-            mensagem = f'❌ ERRO: {len(locais_conflito)} local(is) foi(ram) ocupado(s) por outro usuário:\n\n• {"; ".join(locais_conflito[:5])}'
-            if len(locais_conflito) > 5:
-                mensagem += f'\n• ... e mais {len(locais_conflito) - 5} local(is)'
-            mensagem += '\n\n🔄 Atualize os dados e tente novamente.'
-            return jsonify({
+            pecas_info = [f"{peca} OP {op}" for op, peca in sorted(pecas_existentes)]
+            mensagem = f'❌ ERRO: {len(pecas_existentes)} peça(s) já otimizada(s) ou no estoque:\n\n• {"; ".join(pecas_info[:5])}'
+            if len(pecas_info) > 5:
+                mensagem += f'\n• ... e mais {len(pecas_info) - 5} peça(s)'
+            mensagem += '\n\n🔧 Atualize os dados e tente novamente.'
+            return {
                 'success': False, 
                 'message': mensagem
-            })
+            }, 200
         
-        print("DEBUG: Todos os locais estão disponíveis. Criando tabela se necessário")
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS public.pu_otimizadas (
-                id SERIAL PRIMARY KEY,
-                op_pai TEXT,
-                op TEXT,
-                peca TEXT,
-                projeto TEXT,
-                veiculo TEXT,
-                local TEXT,
-                rack TEXT,
-                cortada BOOLEAN DEFAULT FALSE,
-                user_otimizacao TEXT,
-                data_otimizacao TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                tipo TEXT DEFAULT 'PU',
-                camada TEXT,
-                lote_vd TEXT,
-                lote_pu TEXT,
-                data_corte DATE
-            )
-        """)
-        
-        # Adicionar colunas se não existirem
-        try:
-            cur.execute("ALTER TABLE public.pu_otimizadas ADD COLUMN IF NOT EXISTS lote_vd TEXT")
-            cur.execute("ALTER TABLE public.pu_otimizadas ADD COLUMN IF NOT EXISTS lote_pu TEXT")
-            cur.execute("ALTER TABLE public.pu_otimizadas ADD COLUMN IF NOT EXISTS data_corte DATE")
-        except:
-            pass
-            
-        conn.commit()
-        print("DEBUG: Tabela criada/verificada. Iniciando inserções...")
-        
-        total_inseridas = 0
+        if dry_run:
+            realocadas, pecas_sem_reserva = prever_locais(conn, pecas_selecionadas)
+        else:
+            # Reservar os locais (travas mantidas até o commit final); como as peças já foram
+            # conferidas acima, um local ocupado só pode ser de outra (op, peça), e essa peça é
+            # trocada para o próximo local livre
+            print("DEBUG: Reservando locais...")
+            if progresso:
+                progresso('reservando', 0, 0)
+            realocadas, pecas_sem_reserva = reservar_locais(conn, pecas_selecionadas)
+            if progresso:
+                progresso('expandindo', 0, 0)
+        
+        if pecas_sem_reserva and not dry_run:
+            conn.rollback()
+            conn.close()
+            pecas_info = [f"{p.get('local')} (peça {p.get('peca', 'N/A')} OP {p.get('op', 'N/A')})" for p in pecas_sem_reserva]
+            mensagem = f'❌ ERRO: {len(pecas_sem_reserva)} local(is) foi(ram) ocupado(s) por outro usuário e não há outro local livre:\n\n• {"; ".join(pecas_info[:5])}'
+            if len(pecas_info) > 5:
+                mensagem += f'\n• ... e mais {len(pecas_info) - 5} local(is)'
+            mensagem += '\n\n🔧 Remova peças do estoque ou cadastre novos locais e tente novamente.'
+            return {
+                'success': False, 
+                'message': mensagem
+            }, 200
+        
+        print("DEBUG: Locais reservados. Iniciando inserções...")
+        
+        # Lotes VD/PU de todas as (op, peça) a inserir, em uma única consulta
+        lotes_pecas = {}
+        if lote_selecionado != 'PUAVULSA':
+            lotes_pecas = resolver_lotes(cur, [
+                (peca.get('op', ''), peca_atual)
+                for peca in pecas_selecionadas
+                for peca_atual in catalogo_camadas.pecas_para_processar(peca.get('projeto', ''), peca.get('peca', ''))
+            ])
+        
+        linhas_otimizadas = []
+        linhas_corte = []
+        pecas_programadas = set()
+        total_pecas_especiais = 0
         
-        print(f"DEBUG: Iniciando inserções para {len(pecas_selecionadas)} peças...")
+        print(f"DEBUG: Expandindo camadas de {len(pecas_selecionadas)} peças...")
         for i, peca in enumerate(pecas_selecionadas):
             if i % 10 == 0 or i == len(pecas_selecionadas) - 1:
                 print(f"DEBUG: Processando peça {i+1}/{len(pecas_selecionadas)}: {peca.get('peca', 'N/A')} OP {peca.get('op', 'N/A')} Local {peca.get('local', 'N/A')}")
@@ -1645,96 +2246,33 @@ def otimizar_pecas():
             projeto = peca.get('projeto', '')
             peca_codigo = peca.get('peca', '')
             
-            # Verificar se há peças especiais definidas
-            cur.execute("""
-                SELECT pecas_especiais FROM public.pu_camadas
-                WHERE projeto = %s AND peca = %s AND pecas_especiais IS NOT NULL AND pecas_especiais != ''
-            """, (projeto, peca_codigo))
-            
-            pecas_especiais_result = cur.fetchone()
-            pecas_para_processar = [peca_codigo]  # Sempre incluir a peça original
-            
-            # Se há peças especiais, usar elas ao invés da peça original
-            if pecas_especiais_result and pecas_especiais_result[0]:
-                pecas_especiais = pecas_especiais_result[0].strip()
-                if pecas_especiais:
-                    # Dividir por hífen e vírgula, limpar espaços
-                    pecas_para_processar = [p.strip() for p in pecas_especiais.replace('-', ',').split(',') if p.strip()]
+            # Peças especiais (se definidas) substituem a peça original
+            pecas_para_processar = catalogo_camadas.pecas_para_processar(projeto, peca_codigo)
+            total_pecas_especiais += len(pecas_para_processar)
+            if peca.get('op', '') and peca_codigo:
+                pecas_programadas.update((peca.get('op', ''), peca_atual) for peca_atual in pecas_para_processar)
             
             # Para cada peça que deve ser processada
             for peca_atual in pecas_para_processar:
-                # Buscar camadas da peça atual na tabela pu_camadas
-                cur.execute("""
-                    SELECT l1, l3, l3_b FROM public.pu_camadas
-                    WHERE projeto = %s AND peca = %s
-                """, (projeto, peca_atual))
-                
-                camadas_result = cur.fetchone()
-                camadas_para_inserir = []
-                
-                if camadas_result:
-                    l1_value = camadas_result[0]
-                    l3_value = camadas_result[1]
-                    l3_b_value = camadas_result[2] if len(camadas_result) > 2 else None
-                    
-                    # Verificar L1
-                    if l1_value and l1_value != '-' and str(l1_value).strip():
-                        try:
-                            qtd_l1 = int(l1_value)
-                            for _ in range(qtd_l1):
-                                camadas_para_inserir.append('L1')
-                        except:
-                            camadas_para_inserir.append('L1')
-                    
-                    # Verificar L3
-                    if l3_value and l3_value != '-' and str(l3_value).strip():
-                        try:
-                            qtd_l3 = int(l3_value)
-                            for _ in range(qtd_l3):
-                                camadas_para_inserir.append('L3')
-                        except:
-                            camadas_para_inserir.append('L3')
-                    
-                    # Verificar L3_B
-                    if l3_b_value and l3_b_value != '-' and str(l3_b_value).strip():
-                        try:
-                            qtd_l3_b = int(l3_b_value)
-                            for _ in range(qtd_l3_b):
-                                camadas_para_inserir.append('L3_B')
-                        except:
-                            camadas_para_inserir.append('L3_B')
+                camadas_para_inserir = catalogo_camadas.camadas(projeto, peca_atual)
                 
                 # Se não encontrou camadas, inserir sem camada
                 if not camadas_para_inserir:
                     camadas_para_inserir = [None]
                 
-                # Buscar lote da peça na tabela plano_controle_corte_vidro2 ou usar lote PUAVULSA
+                # Lote da peça (resolvido antes do laço) ou lote PUAVULSA
                 if lote_selecionado == 'PUAVULSA':
                     lote_vd = lote_final
                     lote_pu = lote_final
                 else:
-                    cur.execute("""
-                        SELECT id_lote FROM public.plano_controle_corte_vidro2
-                        WHERE op = %s AND peca = %s
-                        LIMIT 1
-                    """, (peca.get('op', ''), peca_atual))
-                    lote_result = cur.fetchone()
-                    if lote_result and lote_result[0]:
-                        lote_vd = lote_result[0]
-                        lote_pu = 'PU' + lote_vd[2:] if len(lote_vd) >= 3 else lote_vd
-                    else:
-                        lote_vd = ''
-                        lote_pu = ''
+                    lote_vd, lote_pu = lotes_pecas.get((peca.get('op', ''), peca_atual), ('', ''))
                 
-                # Inserir uma linha para cada camada
+                # Uma linha para cada camada
                 for camada in camadas_para_inserir:
                     # Converter L3_B para L3 no banco (manter compatibilidade)
                     camada_db = 'L3' if camada == 'L3_B' else camada
                     
-                    cur.execute("""
-                        INSERT INTO public.pu_otimizadas (op_pai, op, peca, projeto, veiculo, local, rack, user_otimizacao, tipo, camada, lote_vd, lote_pu, data_corte)
-                        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, 'PU', %s, %s, %s, %s)
-                    """, (
+                    linhas_otimizadas.append((
                         peca.get('op_pai', ''),
                         peca.get('op', ''),
                         peca_atual,  # Usar a peça atual (pode ser especial)
@@ -1742,85 +2280,64 @@ def otimizar_pecas():
                         peca.get('veiculo', ''),
                         peca.get('local', ''),
                         peca.get('rack', ''),
-                        current_user.username,
+                        usuario,
                         camada_db,
                         lote_vd,
                         lote_pu,
                         data_corte
                     ))
                     
-                    # Inserir também na tabela pu_corte
-                    cur.execute("""
-                        INSERT INTO public.pu_corte (op, peca, projeto, veiculo, user_otimizacao, tipo, camada)
-                        VALUES (%s, %s, %s, %s, %s, %s, %s)
-                    """, (
+                    # Também vai para a tabela pu_corte
+                    linhas_corte.append((
                         peca.get('op', ''),
                         peca_atual,  # Usar a peça atual (pode ser especial)
                         peca.get('projeto', ''),
                         peca.get('veiculo', ''),
-                        current_user.username,
+                        usuario,
                         'PU',
                         camada_db
                     ))
-                    
-                    total_inseridas += 1
             
             if i % 10 == 0 or i == len(pecas_selecionadas) - 1:
-                print(f"DEBUG: Peça {i+1} processada com {len(pecas_para_processar)} peça(s) especiais")
+                print(f"DEBUG: Peça {i+1} expandida com {len(pecas_para_processar)} peça(s) especiais")
+            if progresso and (i % 25 == 24 or i == len(pecas_selecionadas) - 1):
+                progresso('expandindo', i + 1, len(linhas_otimizadas))
+        
+        if dry_run:
+            conn.rollback()
+            conn.close()
+            return montar_previa_otimizacao(pecas_selecionadas, linhas_otimizadas, total_pecas_especiais, realocadas, pecas_sem_reserva), 200
+        
+        # Gravar todas as camadas com INSERTs de várias linhas (em vez de um INSERT por camada)
+        print(f"DEBUG: Inserindo {len(linhas_otimizadas)} linha(s) em pu_otimizadas e pu_corte...")
+        if progresso:
+            progresso('gravando', len(pecas_selecionadas), 0)
+        psycopg2.extras.execute_values(cur, """
+            INSERT INTO public.pu_otimizadas (op_pai, op, peca, projeto, veiculo, local, rack, user_otimizacao, tipo, camada, lote_vd, lote_pu, data_corte)
+            VALUES %s
+        """, linhas_otimizadas, template="(%s, %s, %s, %s, %s, %s, %s, %s, 'PU', %s, %s, %s, %s)", page_size=1000)
+        psycopg2.extras.execute_values(cur, """
+            INSERT INTO public.pu_corte (op, peca, projeto, veiculo, user_otimizacao, tipo, camada)
+            VALUES %s
+        """, linhas_corte, page_size=1000)
+        total_inseridas = len(linhas_otimizadas)
+        if progresso:
+            progresso('finalizando', len(pecas_selecionadas), total_inseridas)
+        
+        # Os locais agora estão ocupados de fato: liberar as reservas da tela de coleta
+        locais_otimizados = [peca.get('local') for peca in pecas_selecionadas if peca.get('local') and peca.get('local') != 'SEM LOCAL']
+        cur.execute("DELETE FROM public.pu_reservas_locais WHERE local = ANY(%s)", (locais_otimizados,))
         
         print(f"DEBUG: Fazendo commit de {total_inseridas} inserções e atualizações de status...")
-        # Atualizar status para PROGRAMADO na tabela plano_controle_corte_vidro2 para todas as peças processadas
-        ops_processadas = set()
-        for peca in pecas_selecionadas:
-            op = peca.get('op', '')
-            peca_codigo = peca.get('peca', '')
-            projeto = peca.get('projeto', '')
-            
-            if op and peca_codigo:
-                # Verificar se há peças especiais para esta peça
-                cur.execute("""
-                    SELECT pecas_especiais FROM public.pu_camadas
-                    WHERE projeto = %s AND peca = %s AND pecas_especiais IS NOT NULL AND pecas_especiais != ''
-                """, (projeto, peca_codigo))
-                
-                pecas_especiais_result = cur.fetchone()
-                pecas_para_atualizar = [peca_codigo]  # Sempre incluir a peça original
-                
-                # Se há peças especiais, incluir elas também
-                if pecas_especiais_result and pecas_especiais_result[0]:
-                    pecas_especiais = pecas_especiais_result[0].strip()
-                    if pecas_especiais:
-                        pecas_para_atualizar = [p.strip() for p in pecas_especiais.replace('-', ',').split(',') if p.strip()]
-                
-                # Atualizar status para cada peça
-                for peca_atual in pecas_para_atualizar:
-                    chave_peca = f"{op}_{peca_atual}"
-                    if chave_peca not in ops_processadas:
-                        cur.execute("""
-                            UPDATE public.plano_controle_corte_vidro2 
-                            SET pu_cortado = 'PROGRAMADO'
-                            WHERE op = %s AND peca = %s
-                        """, (op, peca_atual))
-                        ops_processadas.add(chave_peca)
-        
-        # Contar quantas peças especiais foram processadas
-        total_pecas_especiais = 0
-        for peca in pecas_selecionadas:
-            projeto = peca.get('projeto', '')
-            peca_codigo = peca.get('peca', '')
-            
+        # Atualizar status para PROGRAMADO na tabela plano_controle_corte_vidro2 para todas as
+        # (op, peça) expandidas, em um único UPDATE
+        if pecas_programadas:
             cur.execute("""
-                SELECT pecas_especiais FROM public.pu_camadas
-                WHERE projeto = %s AND peca = %s AND pecas_especiais IS NOT NULL AND pecas_especiais != ''
-            """, (projeto, peca_codigo))
-            
-            pecas_especiais_result = cur.fetchone()
-            if pecas_especiais_result and pecas_especiais_result[0]:
-                pecas_especiais = pecas_especiais_result[0].strip()
-                if pecas_especiais:
-                    total_pecas_especiais += len([p.strip() for p in pecas_especiais.replace('-', ',').split(',') if p.strip()])
-            else:
-                total_pecas_especiais += 1
+                UPDATE public.plano_controle_corte_vidro2 c
+                SET pu_cortado = 'PROGRAMADO'
+                FROM unnest(%s::text[], %s::text[]) AS p(op, peca)
+                WHERE c.op = p.op AND c.peca = p.peca
+            """, ([op for op, _ in pecas_programadas], [peca_atual for _, peca_atual in pecas_programadas]))
         
         conn.commit()
         conn.close()
@@ -1848,11 +2365,18 @@ def otimizar_pecas():
             else:
                 mensagem += f'📍 Locais utilizados: {", ".join(locais_ordenados[:10])} e mais {len(locais_ordenados) - 10}'
         
-        return jsonify({
+        if realocadas:
+            trocas = [f"{r['peca']} OP {r['op']}: {r['de']} → {r['para']}" for r in realocadas]
+            mensagem += f'\n\n🔄 {len(realocadas)} peça(s) realocada(s) (local ocupado por outro usuário):\n• {"; ".join(trocas[:5])}'
+            if len(trocas) > 5:
+                mensagem += f'\n• ... e mais {len(trocas) - 5} peça(s)'
+        
+        return {
             'success': True, 
             'message': mensagem,
+            'realocadas': realocadas,
             'redirect': '/otimizadas'
-        })
+        }, 200
     
     except Exception as e:
         if conn:
@@ -1864,10 +2388,247 @@ def otimizar_pecas():
         import traceback
         error_msg = traceback.format_exc()
         print(f"ERRO CRÍTICO na otimização: {error_msg}")
-        return jsonify({
+        return {
             'success': False, 
             'message': f'❌ ERRO: Falha na otimização.\n\nDetalhes: {str(e)}\n\nTente novamente ou contate o suporte T.I.'
-        }), 500
+        }, 500
+
+def montar_previa_otimizacao(pecas, linhas_otimizadas, total_pecas_especiais, realocadas, sem_local):
+    """Resposta do dry_run: totais, camadas por tipo e as linhas que iriam para pu_otimizadas"""
+    camadas = {}
+    for linha in linhas_otimizadas:
+        camada = linha[8] or 'SEM CAMADA'
+        camadas[camada] = camadas.get(camada, 0) + 1
+    
+    mensagem = '🔎 PRÉVIA DA OTIMIZAÇÃO (nada foi gravado)\n\n'
+    mensagem += f'• {len(pecas)} peça(s) selecionada(s)\n'
+    if total_pecas_especiais > len(pecas):
+        mensagem += f'• {total_pecas_especiais} peças especiais geradas\n'
+    mensagem += f'• {len(linhas_otimizadas)} linha(s) na otimização\n'
+    if camadas:
+        mensagem += f'• Camadas: {", ".join(f"{c}: {n}" for c, n in sorted(camadas.items()))}\n'
+    if realocadas:
+        mensagem += f'\n🔄 {len(realocadas)} local(is) já ocupado(s), a(s) peça(s) seria(m) realocada(s)'
+    if sem_local:
+        mensagem += f'\n❌ {len(sem_local)} peça(s) sem local livre: a otimização não seria concluída'
+    
+    return {
+        'success': True,
+        'dry_run': True,
+        'message': mensagem,
+        'pecas': len(pecas),
+        'pecas_especiais': total_pecas_especiais,
+        'linhas_otimizadas': len(linhas_otimizadas),
+        'camadas': camadas,
+        'realocadas': realocadas,
+        'sem_local': [{'op': p.get('op', ''), 'peca': p.get('peca', ''), 'local': p.get('local')} for p in sem_local],
+        'plano': [
+            {'op': l[1], 'peca': l[2], 'local': l[5], 'rack': l[6], 'camada': l[8], 'lote_vd': l[9], 'lote_pu': l[10]}
+            for l in linhas_otimizadas
+        ]
+    }
+
+@app.route('/api/otimizar-pecas', methods=['POST'])
+@login_required
+def otimizar_pecas():
+    dados = request.get_json() or {}
+    usuario = current_user.username
+    return responder_idempotente('otimizar-pecas', usuario, lambda: iniciar_otimizacao(dados, usuario))
+
+def iniciar_otimizacao(dados, usuario):
+    """Otimiza na própria requisição ou, com `assincrono`, em um job em segundo plano"""
+    if not dados.get('assincrono') or dados.get('dry_run'):
+        return executar_otimizacao(dados, usuario)
+    
+    # Modo assíncrono: a otimização roda em uma thread e a tela acompanha por /api/jobs/<id>
+    try:
+        job_id = criar_job('otimizacao', usuario, len(dados.get('pecas', [])))
+    except Exception as e:
+        print(f"ERRO ao criar job de otimização: {e}")
+        return {'success': False, 'message': f'❌ ERRO: Não foi possível iniciar a otimização.\n\nDetalhes: {str(e)}'}, 500
+    
+    threading.Thread(
+        target=executar_job,
+        args=(job_id, executar_otimizacao, dados, usuario),
+        daemon=True
+    ).start()
+    return {'success': True, 'job_id': job_id, 'status_url': url_for('api_job', job_id=job_id)}, 202
+
+def responder_idempotente(endpoint, usuario, executar):
+    """Executa `executar()` -> (resposta, status) uma única vez por cabeçalho Idempotency-Key
+
+    A primeira requisição com a chave grava o resultado em public.pu_idempotencia; a repetição
+    (tablet que perdeu a resposta e reenviou) recebe esse resultado sem gravar nada de novo.
+    Erros 5xx não ficam gravados (a transação foi desfeita), então a repetição executa de novo.
+    A chave vale só para o usuário que a registrou: outro usuário com a mesma chave recebe 422.
+    Sem o cabeçalho, executa normalmente.
+    """
+    chave = request.headers.get('Idempotency-Key', '').strip()
+    if not chave:
+        resposta, status = executar()
+        return jsonify(resposta), status
+    
+    conn = get_db_connection()
+    try:
+        cur = conn.cursor()
+        # Registrar a chave; uma execução interrompida (worker reiniciado) pode ser retomada
+        cur.execute("""
+            INSERT INTO public.pu_idempotencia (endpoint, chave, usuario)
+            VALUES (%s, %s, %s)
+            ON CONFLICT (endpoint, chave) DO UPDATE
+            SET usuario = EXCLUDED.usuario, criado_em = CURRENT_TIMESTAMP
+            WHERE pu_idempotencia.status = 'processando'
+              AND pu_idempotencia.usuario IS NOT DISTINCT FROM EXCLUDED.usuario
+              AND pu_idempotencia.criado_em < CURRENT_TIMESTAMP - %s * INTERVAL '1 minute'
+            RETURNING chave
+        """, (endpoint, chave, usuario, JOB_TIMEOUT_MINUTOS))
+        registrada = cur.fetchone() is not None
+        if not registrada:
+            cur.execute("""
+                SELECT status, status_http, resposta, usuario FROM public.pu_idempotencia
+                WHERE endpoint = %s AND chave = %s
+            """, (endpoint, chave))
+            anterior = cur.fetchone()
+        conn.commit()
+    finally:
+        conn.close()
+    
+    if not registrada:
+        if anterior and anterior[3] != usuario:
+            return jsonify({
+                'success': False,
+                'message': '❌ ERRO: Chave de envio usada por outro usuário. Atualize a tela e tente novamente.'
+            }), 422
+        if anterior and anterior[0] == 'concluido':
+            print(f"DEBUG: {endpoint} repetido com a chave {chave}, devolvendo o resultado gravado")
+            return jsonify(anterior[2]), anterior[1]
+        return jsonify({
+            'success': False,
+            'message': '⏳ Esta solicitação ainda está sendo processada. Aguarde alguns instantes e atualize a tela.'
+        }), 409
+    
+    try:
+        resposta, status = executar()
+    except Exception:
+        status = 500
+        raise
+    finally:
+        conn = get_db_connection()
+        try:
+            cur = conn.cursor()
+            if status >= 500:
+                cur.execute("DELETE FROM public.pu_idempotencia WHERE endpoint = %s AND chave = %s", (endpoint, chave))
+            else:
+                cur.execute("""
+                    UPDATE public.pu_idempotencia
+                    SET status = 'concluido', status_http = %s, resposta = %s
+                    WHERE endpoint = %s AND chave = %s
+                """, (status, json.dumps(resposta), endpoint, chave))
+            conn.commit()
+        finally:
+            conn.close()
+    return jsonify(resposta), status
+
+def criar_job(tipo, usuario, total):
+    """Registra um job em public.pu_jobs e retorna o id"""
+    job_id = uuid.uuid4().hex
+    conn = get_db_connection()
+    try:
+        cur = conn.cursor()
+        cur.execute("""
+            INSERT INTO public.pu_jobs (id, tipo, usuario, total)
+            VALUES (%s, %s, %s, %s)
+        """, (job_id, tipo, usuario, total))
+        conn.commit()
+    finally:
+        conn.close()
+    return job_id
+
+def executar_job(job_id, funcao, dados, usuario):
+    """Roda `funcao(dados, usuario, progresso)` gravando o andamento em public.pu_jobs
+
+    O andamento vai por uma conexão própria (autocommit), separada da transação da função:
+    enquanto ela não faz commit, nada do job aparece nas tabelas de trabalho. Enquanto a função
+    roda, atualizado_em também é renovado periodicamente (mesmo parada esperando uma trava),
+    então o job só é dado como interrompido se o worker morrer.
+    """
+    conn_job = get_db_connection()
+    conn_job.autocommit = True
+    cur_job = conn_job.cursor()
+    trava_job = threading.Lock()
+    terminou = threading.Event()
+    
+    def progresso(etapa, processadas, inseridas):
+        with trava_job:
+            cur_job.execute("""
+                UPDATE public.pu_jobs
+                SET etapa = %s, processadas = %s, inseridas = %s, atualizado_em = CURRENT_TIMESTAMP
+                WHERE id = %s
+            """, (etapa, processadas, inseridas, job_id))
+    
+    def batimento():
+        while not terminou.wait(max(JOB_TIMEOUT_MINUTOS * 60 / 4, 1)):
+            try:
+                with trava_job:
+                    cur_job.execute("UPDATE public.pu_jobs SET atualizado_em = CURRENT_TIMESTAMP WHERE id = %s", (job_id,))
+            except Exception as e:
+                print(f"DEBUG: Falha ao renovar o job {job_id}: {e}")
+    
+    threading.Thread(target=batimento, daemon=True).start()
+    try:
+        cur_job.execute("""
+            UPDATE public.pu_jobs SET status = 'executando', atualizado_em = CURRENT_TIMESTAMP WHERE id = %s
+        """, (job_id,))
+        resposta, _ = funcao(dados, usuario, progresso)
+    except Exception as e:
+        print(f"ERRO no job {job_id}: {e}")
+        resposta = {'success': False, 'message': f'❌ ERRO: {str(e)}'}
+    finally:
+        terminou.set()
+    
+    try:
+        with trava_job:
+            cur_job.execute("""
+                UPDATE public.pu_jobs
+                SET status = %s, etapa = 'finalizado', resultado = %s, atualizado_em = CURRENT_TIMESTAMP
+                WHERE id = %s
+            """, ('concluido' if resposta.get('success') else 'erro', json.dumps(resposta), job_id))
+    finally:
+        with trava_job:
+            conn_job.close()
+
+@app.route('/api/jobs/<job_id>')
+@login_required
+def api_job(job_id):
+    try:
+        conn = get_db_connection()
+        cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        cur.execute("""
+            SELECT id, tipo, usuario, status, etapa, total, processadas, inseridas, resultado,
+                   criado_em, atualizado_em,
+                   atualizado_em < CURRENT_TIMESTAMP - %s * INTERVAL '1 minute' AS parado
+            FROM public.pu_jobs
+            WHERE id = %s AND usuario = %s
+        """, (JOB_TIMEOUT_MINUTOS, job_id, current_user.username))
+        job = cur.fetchone()
+        conn.close()
+        
+        if not job:
+            return jsonify({'success': False, 'message': 'Job não encontrado'}), 404
+        
+        resultado = dict(job)
+        # Worker reiniciado no meio do job: a transação foi desfeita, nada foi gravado
+        if resultado.pop('parado') and resultado['status'] in ('pendente', 'executando'):
+            resultado['status'] = 'interrompido'
+            resultado['resultado'] = {
+                'success': False,
+                'message': '❌ ERRO: A otimização foi interrompida e nada foi gravado. Tente novamente.'
+            }
+        resultado['criado_em'] = resultado['criado_em'].isoformat()
+        resultado['atualizado_em'] = resultado['atualizado_em'].isoformat()
+        return jsonify(resultado)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
 
 @app.route('/api/otimizadas')
 @login_required
@@ -1965,116 +2726,68 @@ def excluir_otimizadas():
 @app.route('/api/enviar-estoque', methods=['POST'])
 @login_required
 def enviar_estoque():
+    dados = request.get_json() or {}
+    usuario = current_user.username
+    return responder_idempotente('enviar-estoque', usuario, lambda: executar_envio_estoque(dados, usuario))
+
+def executar_envio_estoque(dados, usuario):
+    """Move as peças otimizadas `dados['ids']` para o estoque. Retorna (resposta, status_http)
+
+    A mudança acontece toda dentro do PostgreSQL, em uma única instrução e uma única transação:
+    o DELETE ... RETURNING em pu_otimizadas alimenta os INSERTs em pu_inventory e pu_controle.
+    """
     conn = None
     try:
-        dados = request.get_json()
         ids = dados.get('ids', [])
         
         if not ids:
-            return jsonify({'success': False, 'message': 'Nenhuma peça selecionada'})
+            return {'success': False, 'message': 'Nenhuma peça selecionada'}, 200
         
-        # Processar em lotes menores para evitar timeout
-        batch_size = 50
-        total_processadas = 0
+        conn = get_db_connection()
+        cur = conn.cursor()
         
-        for i in range(0, len(ids), batch_size):
-            batch_ids = ids[i:i + batch_size]
-            
-            conn = get_db_connection()
-            conn.autocommit = False
-            
-            try:
-                cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-                
-                # Buscar peças do lote atual
-                placeholders = ','.join(['%s'] * len(batch_ids))
-                cur.execute(f"""
-                    SELECT * FROM public.pu_otimizadas 
-                    WHERE id IN ({placeholders}) AND tipo = 'PU'
-                """, batch_ids)
-                pecas = cur.fetchall()
-                
-                if not pecas:
-                    conn.close()
-                    continue
-                
-                # Preparar dados para inserção em lote
-                dados_estoque = []
-                dados_controle = []
-                lotes_para_atualizar = set()
-                
-                for peca in pecas:
-                    dados_estoque.append((
-                        peca['op_pai'], peca['op'], peca['peca'], peca['projeto'], 
-                        peca['veiculo'], peca['local'], peca['rack'], 
-                        current_user.username, peca.get('camada'), peca.get('lote_vd'), peca.get('lote_pu')
-                    ))
-                    
-                    dados_controle.append((
-                        peca['op_pai'], peca['op'], peca['peca'], peca['projeto'], 
-                        peca['veiculo'], peca['local'], peca['rack'], True, 
-                        current_user.username, 'PU', peca.get('camada')
-                    ))
-                    
-                    # Coletar lotes para atualizar status
-                    if peca.get('lote_vd'):
-                        lotes_para_atualizar.add(peca.get('lote_vd'))
-                
-                # Adicionar colunas lote_vd e lote_pu se não existirem
-                try:
-                    cur.execute("ALTER TABLE public.pu_inventory ADD COLUMN IF NOT EXISTS lote_vd TEXT")
-                    cur.execute("ALTER TABLE public.pu_inventory ADD COLUMN IF NOT EXISTS lote_pu TEXT")
-                except:
-                    pass
-                
-                # Inserção em lote no estoque
-                cur.executemany("""
-                    INSERT INTO public.pu_inventory (op_pai, op, peca, projeto, veiculo, local, rack, data, usuario, camada, lote_vd, lote_pu)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, CURRENT_TIMESTAMP, %s, %s, %s, %s)
-                """, dados_estoque)
-                
-                # Verificar e atualizar status dos lotes
-                for lote in lotes_para_atualizar:
-                    lote_pu = 'PU' + lote[2:] if len(lote) >= 2 else lote
-                    verificar_e_atualizar_status_lote(lote, lote_pu, cur)
-                
-                # Inserção em lote no controle
-                cur.executemany("""
-                    INSERT INTO public.pu_controle (op_pai, op, peca, projeto, veiculo, local, rack, cortada, user_otimizacao, tipo, camada)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                """, dados_controle)
-                
-                # Remover da tabela de otimizadas em lote
-                cur.execute(f"DELETE FROM public.pu_otimizadas WHERE id IN ({placeholders})", batch_ids)
-                
-                conn.commit()
-                total_processadas += len(pecas)
-                
-            except Exception as batch_error:
-                conn.rollback()
-                raise batch_error
-            finally:
-                conn.close()
+        cur.execute("""
+            WITH movidas AS (
+                DELETE FROM public.pu_otimizadas
+                WHERE id = ANY(%s::int[]) AND tipo = 'PU'
+                RETURNING op_pai, op, peca, projeto, veiculo, local, rack, camada, lote_vd, lote_pu
+            ), estoque AS (
+                INSERT INTO public.pu_inventory (op_pai, op, peca, projeto, veiculo, local, rack, data, usuario, camada, lote_vd, lote_pu)
+                SELECT op_pai, op, peca, projeto, veiculo, local, rack, CURRENT_TIMESTAMP, %s, camada, lote_vd, lote_pu
+                FROM movidas
+            ), controle AS (
+                INSERT INTO public.pu_controle (op_pai, op, peca, projeto, veiculo, local, rack, cortada, user_otimizacao, tipo, camada)
+                SELECT op_pai, op, peca, projeto, veiculo, local, rack, TRUE, %s, 'PU', camada
+                FROM movidas
+            )
+            SELECT COUNT(*),
+                   COALESCE(array_agg(DISTINCT lote_vd) FILTER (WHERE lote_vd IS NOT NULL AND lote_vd <> ''), '{}')
+            FROM movidas
+        """, (ids, usuario, usuario))
+        total_processadas, lotes_para_atualizar = cur.fetchone()
+        
+        # Verificar e atualizar status dos lotes (as linhas novas do estoque já são visíveis aqui)
+        for lote in lotes_para_atualizar:
+            verificar_e_atualizar_status_lote(lote, cur)
         
         # Log da ação final
         if total_processadas > 0:
-            conn = get_db_connection()
-            cur = conn.cursor()
             cur.execute("""
                 INSERT INTO public.pu_logs (usuario, acao, detalhes, data_acao)
                 VALUES (%s, %s, %s, CURRENT_TIMESTAMP)
             """, (
-                current_user.username,
+                usuario,
                 'ENVIAR_ESTOQUE',
                 f'Enviou {total_processadas} peça(s) para o estoque'
             ))
-            conn.commit()
-            conn.close()
         
-        return jsonify({
+        conn.commit()
+        conn.close()
+        
+        return {
             'success': True,
             'message': f'{total_processadas} peça(s) enviada(s) para o estoque com sucesso!'
-        })
+        }, 200
     
     except Exception as e:
         if conn:
@@ -2083,7 +2796,7 @@ def enviar_estoque():
                 conn.close()
             except:
                 pass
-        return jsonify({'success': False, 'message': f'Erro: {str(e)}'}), 500
+        return {'success': False, 'message': f'Erro: {str(e)}'}, 500
 
 @app.route('/api/estoque-estatisticas')
 @login_required
@@ -2139,29 +2852,25 @@ def verificar_pecas_restantes():
         conn = get_db_connection()
         cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
         
-        # Buscar OP+PEÇA das peças selecionadas
-        placeholders = ','.join(['%s'] * len(ids))
-        cur.execute(f"SELECT DISTINCT op, peca FROM public.pu_inventory WHERE id IN ({placeholders})", ids)
-        pecas_selecionadas = cur.fetchall()
+        # Para cada OP+PEÇA das peças selecionadas: total no estoque e quantas foram selecionadas
+        cur.execute("""
+            SELECT i.op, i.peca,
+                   COUNT(*) AS total_estoque,
+                   COUNT(*) FILTER (WHERE i.id = ANY(%(ids)s::int[])) AS selecionadas
+            FROM public.pu_inventory i
+            WHERE (i.op, i.peca) IN (
+                SELECT op, peca FROM public.pu_inventory WHERE id = ANY(%(ids)s::int[])
+            )
+            GROUP BY i.op, i.peca
+            ORDER BY i.op, i.peca
+        """, {'ids': ids})
         
         alertas = []
-        
-        for peca_sel in pecas_selecionadas:
-            op = peca_sel['op']
-            peca = peca_sel['peca']
-            
-            # Contar total de peças desta OP+PEÇA no estoque
-            cur.execute("SELECT COUNT(*) FROM public.pu_inventory WHERE op = %s AND peca = %s", (op, peca))
-            total_estoque = cur.fetchone()[0]
-            
-            # Contar quantas das peças selecionadas são desta OP+PEÇA
-            cur.execute(f"SELECT COUNT(*) FROM public.pu_inventory WHERE id IN ({placeholders}) AND op = %s AND peca = %s", ids + [op, peca])
-            selecionadas_desta_peca = cur.fetchone()[0]
-            
+        for grupo in cur.fetchall():
             # Se vai sobrar peça no estoque
-            if total_estoque > selecionadas_desta_peca:
-                restantes = total_estoque - selecionadas_desta_peca
-                alertas.append(f"Ainda restam {restantes} peça(s) {peca} OP {op} no estoque!")
+            if grupo['total_estoque'] > grupo['selecionadas']:
+                restantes = grupo['total_estoque'] - grupo['selecionadas']
+                alertas.append(f"Ainda restam {restantes} peça(s) {grupo['peca']} OP {grupo['op']} no estoque!")
         
         conn.close()
         
@@ -2174,51 +2883,65 @@ def verificar_pecas_restantes():
     except Exception as e:
         return jsonify({'success': False, 'message': f'Erro: {str(e)}'}), 500
 
+def registrar_saidas_estoque(cur, usuario, motivo, ids=(), grupos=()):
+    """Tira peças de public.pu_inventory e registra a saída em public.pu_exit com `motivo`
+
+    Aceita muitos ids e/ou muitos grupos (op, peca) de uma vez: é uma única instrução, em que o
+    DELETE ... RETURNING no estoque alimenta o INSERT no histórico de saídas. Não faz commit.
+    Retorna quantas peças saíram.
+    """
+    grupos = list(grupos)
+    cur.execute("""
+        WITH saidas AS (
+            DELETE FROM public.pu_inventory
+            WHERE id = ANY(%(ids)s::int[])
+               OR (op, peca) IN (SELECT g.op, g.peca FROM unnest(%(ops)s::text[], %(pecas)s::text[]) AS g(op, peca))
+            RETURNING op_pai, op, peca, projeto, veiculo, local, rack, lote_vd, lote_pu
+        ), registradas AS (
+            INSERT INTO public.pu_exit (op_pai, op, peca, projeto, veiculo, local, rack, usuario, data, motivo, lote_vd, lote_pu)
+            SELECT op_pai, op, peca, projeto, veiculo, local, rack, %(usuario)s, CURRENT_TIMESTAMP, %(motivo)s, lote_vd, lote_pu
+            FROM saidas
+        )
+        SELECT COUNT(*) FROM saidas
+    """, {
+        'ids': list(ids),
+        'ops': [op for op, _ in grupos],
+        'pecas': [peca for _, peca in grupos],
+        'usuario': usuario,
+        'motivo': motivo
+    })
+    return cur.fetchone()[0]
+
 @app.route('/api/remover-grupo-estoque', methods=['POST'])
 @login_required
 def remover_grupo_estoque():
-    """Remove todas as peças de um grupo (OP+PEÇA) do estoque"""
+    """Remove todas as peças de um grupo (OP+PEÇA) do estoque, ou de vários grupos em 'grupos'"""
+    conn = None
     try:
         dados = request.get_json()
-        op = dados.get('op', '').strip()
-        peca = dados.get('peca', '').strip()
+        grupos = [(g.get('op', '').strip(), g.get('peca', '').strip()) for g in dados.get('grupos', [])]
+        if not grupos:
+            grupos = [(dados.get('op', '').strip(), dados.get('peca', '').strip())]
         
-        if not op or not peca:
+        if not all(op and peca for op, peca in grupos):
             return jsonify({'success': False, 'message': 'OP e peça são obrigatórios'})
         
         conn = get_db_connection()
-        cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        cur = conn.cursor()
         
-        # Buscar todas as peças do grupo
-        cur.execute("SELECT * FROM public.pu_inventory WHERE op = %s AND peca = %s", (op, peca))
-        pecas = cur.fetchall()
+        # Remover do estoque e inserir no histórico de saídas
+        total_removidas = registrar_saidas_estoque(cur, current_user.username, 'SAÍDA GRUPO COMPLETO', grupos=grupos)
         
-        if not pecas:
+        if not total_removidas:
+            conn.rollback()
             conn.close()
             return jsonify({'success': False, 'message': 'Nenhuma peça encontrada'})
         
-        # Adicionar colunas se não existirem
-        try:
-            cur.execute("ALTER TABLE public.pu_exit ADD COLUMN IF NOT EXISTS lote_vd TEXT")
-            cur.execute("ALTER TABLE public.pu_exit ADD COLUMN IF NOT EXISTS lote_pu TEXT")
-        except:
-            pass
-        
-        # Inserir no histórico de saídas
-        for peca_item in pecas:
-            cur.execute("""
-                INSERT INTO public.pu_exit (op_pai, op, peca, projeto, veiculo, local, rack, usuario, data, motivo, lote_vd, lote_pu)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, CURRENT_TIMESTAMP, %s, %s, %s)
-            """, (
-                peca_item.get('op_pai', ''), peca_item['op'], peca_item['peca'],
-                peca_item.get('projeto', ''), peca_item.get('veiculo', ''),
-                peca_item['local'], peca_item.get('rack', ''),
-                current_user.username, 'SAÍDA GRUPO COMPLETO',
-                peca_item.get('lote_vd'), peca_item.get('lote_pu')
-            ))
-        
-        # Remover do estoque
-        cur.execute("DELETE FROM public.pu_inventory WHERE op = %s AND peca = %s", (op, peca))
+        if len(grupos) == 1:
+            op, peca = grupos[0]
+            descricao = f'{peca} OP {op}'
+        else:
+            descricao = f'de {len(grupos)} grupos'
         
         # Log da ação
         cur.execute("""
@@ -2227,7 +2950,7 @@ def remover_grupo_estoque():
         """, (
             current_user.username,
             'SAIDA_GRUPO_COMPLETO',
-            f'Removeu grupo completo {peca} OP {op} ({len(pecas)} peças) do estoque'
+            f'Removeu grupo completo {descricao} ({total_removidas} peças) do estoque'
         ))
         
         conn.commit()
@@ -2235,10 +2958,16 @@ def remover_grupo_estoque():
         
         return jsonify({
             'success': True,
-            'message': f'Grupo {peca} OP {op} removido com sucesso! ({len(pecas)} peças)'
+            'message': f'Grupo {descricao} removido com sucesso! ({total_removidas} peças)'
         })
         
     except Exception as e:
+        if conn:
+            try:
+                conn.rollback()
+                conn.close()
+            except:
+                pass
         return jsonify({'success': False, 'message': f'Erro: {str(e)}'}), 500
 
 @app.route('/api/remover-estoque', methods=['POST'])
@@ -2257,79 +2986,25 @@ def remover_estoque():
         if tipo_operacao == 'saida_massiva' and len(ids) > 1:
             motivo = 'SAÍDA MASSIVA'
             acao_log = 'SAIDA_MASSIVA'
-            detalhes_log = f'Realizou saída massiva de {len(ids)} peça(s) do estoque'
         else:
             motivo = 'SAÍDA DO ESTOQUE'
             acao_log = 'SAIDA_ESTOQUE'
-            detalhes_log = f'Removeu {len(ids)} peça(s) do estoque'
         
-        # Processar em lotes menores para evitar timeout
-        batch_size = 50
-        total_removidas = 0
+        conn = get_db_connection()
+        cur = conn.cursor()
         
-        for i in range(0, len(ids), batch_size):
-            batch_ids = ids[i:i + batch_size]
-            
-            conn = get_db_connection()
-            conn.autocommit = False
-            
-            try:
-                cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-                
-                # Buscar peças do lote atual
-                placeholders = ','.join(['%s'] * len(batch_ids))
-                cur.execute(f"SELECT * FROM public.pu_inventory WHERE id IN ({placeholders})", batch_ids)
-                pecas = cur.fetchall()
-                
-                if not pecas:
-                    conn.close()
-                    continue
-                
-                # Adicionar colunas lote_vd e lote_pu se não existirem na tabela pu_exit
-                try:
-                    cur.execute("ALTER TABLE public.pu_exit ADD COLUMN IF NOT EXISTS lote_vd TEXT")
-                    cur.execute("ALTER TABLE public.pu_exit ADD COLUMN IF NOT EXISTS lote_pu TEXT")
-                except:
-                    pass
-                
-                # Preparar dados para inserção em lote no pu_exit
-                dados_exit = []
-                for peca in pecas:
-                    dados_exit.append((
-                        peca.get('op_pai', ''), peca['op'], peca['peca'], 
-                        peca.get('projeto', ''), peca.get('veiculo', ''), 
-                        peca['local'], peca.get('rack', ''), 
-                        current_user.username, motivo, peca.get('lote_vd'), peca.get('lote_pu')
-                    ))
-                
-                # Inserção em lote no pu_exit
-                cur.executemany("""
-                    INSERT INTO public.pu_exit (op_pai, op, peca, projeto, veiculo, local, rack, usuario, data, motivo, lote_vd, lote_pu)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, CURRENT_TIMESTAMP, %s, %s, %s)
-                """, dados_exit)
-                
-                # Remover do estoque em lote
-                cur.execute(f"DELETE FROM public.pu_inventory WHERE id IN ({placeholders})", batch_ids)
-                
-                conn.commit()
-                total_removidas += len(pecas)
-                
-            except Exception as batch_error:
-                conn.rollback()
-                raise batch_error
-            finally:
-                conn.close()
+        # Todas as peças saem em uma única instrução e uma única transação
+        total_removidas = registrar_saidas_estoque(cur, current_user.username, motivo, ids=ids)
         
         # Log da ação final
         if total_removidas > 0:
-            conn = get_db_connection()
-            cur = conn.cursor()
             cur.execute("""
                 INSERT INTO public.pu_logs (usuario, acao, detalhes, data_acao)
                 VALUES (%s, %s, %s, CURRENT_TIMESTAMP)
             """, (current_user.username, acao_log, f'Removeu {total_removidas} peça(s) do estoque'))
-            conn.commit()
-            conn.close()
+        
+        conn.commit()
+        conn.close()
         
         return jsonify({'success': True, 'message': f'{total_removidas} peça(s) removida(s) do estoque!'})
     
@@ -2526,15 +3201,11 @@ def api_contagem_pecas_locais():
     try:
         conn = get_db_connection()
         cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-        
-        cur.execute("""
-            SELECT local, COUNT(*) as total 
-            FROM (
-                SELECT local FROM public.pu_inventory WHERE local IS NOT NULL AND local != ''
-                UNION ALL
-                SELECT local FROM public.pu_otimizadas WHERE tipo = 'PU' AND local IS NOT NULL AND local != ''
-            ) AS combined
-            GROUP BY local
+        
+        cur.execute("""
+            SELECT local, estoque + otimizadas AS total
+            FROM public.pu_ocupacao
+            WHERE estoque + otimizadas > 0
         """)
         dados = [dict(row) for row in cur.fetchall()]
         
@@ -2604,15 +3275,435 @@ def popular_locais_iniciais():
         except Exception as e2:
             print(f"Erro ao criar tabela: {e2}")
 
+def preparar_estruturas_alocacao():
+    """Cria as tabelas de apoio da alocação de locais (idempotente)"""
+    conn = get_db_connection()
+    try:
+        cur = conn.cursor()
+        # Vários workers do gunicorn sobem juntos: serializar a criação das estruturas
+        cur.execute("SELECT pg_advisory_xact_lock(hashtext('app_pu_estruturas_alocacao'))")
+        
+        # Versões usadas para invalidar caches em memória entre os workers
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS public.pu_versoes (
+                nome TEXT PRIMARY KEY,
+                versao BIGINT NOT NULL DEFAULT 0
+            )
+        """)
+
+        # Jobs em segundo plano (otimizações grandes) e seu andamento
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS public.pu_jobs (
+                id TEXT PRIMARY KEY,
+                tipo TEXT NOT NULL,
+                usuario TEXT,
+                status TEXT NOT NULL DEFAULT 'pendente',
+                etapa TEXT,
+                total INTEGER NOT NULL DEFAULT 0,
+                processadas INTEGER NOT NULL DEFAULT 0,
+                inseridas INTEGER NOT NULL DEFAULT 0,
+                resultado JSONB,
+                criado_em TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                atualizado_em TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        cur.execute("DELETE FROM public.pu_jobs WHERE criado_em < CURRENT_TIMESTAMP - INTERVAL '7 days'")
+
+        # Resultado das requisições com Idempotency-Key (reenvios devolvem o resultado gravado)
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS public.pu_idempotencia (
+                endpoint TEXT NOT NULL,
+                chave TEXT NOT NULL,
+                usuario TEXT,
+                status TEXT NOT NULL DEFAULT 'processando',
+                status_http INTEGER,
+                resposta JSONB,
+                criado_em TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (endpoint, chave)
+            )
+        """)
+        cur.execute("DELETE FROM public.pu_idempotencia WHERE criado_em < CURRENT_TIMESTAMP - INTERVAL '7 days'")
+
+        # Locais sugeridos na tela de coleta, reservados por usuário/lote até expira_em
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS public.pu_reservas_locais (
+                local TEXT PRIMARY KEY,
+                rack TEXT,
+                usuario TEXT NOT NULL,
+                lote TEXT NOT NULL,
+                op TEXT,
+                peca TEXT,
+                expira_em TIMESTAMP NOT NULL
+            )
+        """)
+        cur.execute("ALTER TABLE public.pu_reservas_locais ADD COLUMN IF NOT EXISTS estrategia TEXT")
+        cur.execute("CREATE INDEX IF NOT EXISTS pu_reservas_locais_usuario_lote_idx ON public.pu_reservas_locais (usuario, lote)")
+        cur.execute("CREATE INDEX IF NOT EXISTS pu_reservas_locais_expira_idx ON public.pu_reservas_locais (expira_em)")
+
+        # As tabelas de peças precisam existir para receber os gatilhos abaixo
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS public.pu_manuais (
+                id SERIAL PRIMARY KEY,
+                op TEXT,
+                peca TEXT,
+                projeto TEXT,
+                veiculo TEXT,
+                local TEXT,
+                rack TEXT,
+                arquivo TEXT,
+                usuario TEXT,
+                data_criacao TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        cur.execute("ALTER TABLE public.pu_manuais ADD COLUMN IF NOT EXISTS lote_vd TEXT")
+        cur.execute("ALTER TABLE public.pu_manuais ADD COLUMN IF NOT EXISTS lote_pu TEXT")
+        cur.execute("ALTER TABLE public.pu_manuais ADD COLUMN IF NOT EXISTS sensor TEXT")
+        cur.execute("ALTER TABLE public.pu_inventory ADD COLUMN IF NOT EXISTS lote_vd TEXT")
+        cur.execute("ALTER TABLE public.pu_inventory ADD COLUMN IF NOT EXISTS lote_pu TEXT")
+        cur.execute("ALTER TABLE IF EXISTS public.pu_exit ADD COLUMN IF NOT EXISTS lote_vd TEXT")
+        cur.execute("ALTER TABLE IF EXISTS public.pu_exit ADD COLUMN IF NOT EXISTS lote_pu TEXT")
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS public.pu_otimizadas (
+                id SERIAL PRIMARY KEY,
+                op_pai TEXT,
+                op TEXT,
+                peca TEXT,
+                projeto TEXT,
+                veiculo TEXT,
+                local TEXT,
+                rack TEXT,
+                cortada BOOLEAN DEFAULT FALSE,
+                user_otimizacao TEXT,
+                data_otimizacao TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                tipo TEXT DEFAULT 'PU',
+                camada TEXT,
+                lote_vd TEXT,
+                lote_pu TEXT,
+                data_corte DATE
+            )
+        """)
+
+        # Tipo de peça de cada local (regra de não misturar tipos), mantido por gatilhos
+        # em pu_inventory, pu_otimizadas (tipo PU) e pu_manuais, com a contagem por origem
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS public.pu_local_tipos (
+                local TEXT NOT NULL,
+                peca TEXT NOT NULL,
+                total INTEGER NOT NULL,
+                PRIMARY KEY (local, peca)
+            )
+        """)
+        cur.execute("ALTER TABLE public.pu_local_tipos ADD COLUMN IF NOT EXISTS estoque INTEGER NOT NULL DEFAULT 0")
+        cur.execute("ALTER TABLE public.pu_local_tipos ADD COLUMN IF NOT EXISTS otimizadas INTEGER NOT NULL DEFAULT 0")
+        cur.execute("ALTER TABLE public.pu_local_tipos ADD COLUMN IF NOT EXISTS manuais INTEGER NOT NULL DEFAULT 0")
+        cur.execute("""
+            CREATE OR REPLACE FUNCTION public.pu_local_tipos_sync() RETURNS trigger AS $$
+            DECLARE
+                antigo jsonb;
+                novo jsonb;
+                origem text;
+            BEGIN
+                origem := CASE TG_TABLE_NAME
+                    WHEN 'pu_inventory' THEN 'estoque'
+                    WHEN 'pu_otimizadas' THEN 'otimizadas'
+                    ELSE 'manuais'
+                END;
+                IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                    antigo := to_jsonb(OLD);
+                END IF;
+                IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                    novo := to_jsonb(NEW);
+                END IF;
+
+                -- Em pu_otimizadas só as linhas tipo PU ocupam local
+                IF TG_TABLE_NAME = 'pu_otimizadas' THEN
+                    IF antigo->>'tipo' IS DISTINCT FROM 'PU' THEN antigo := NULL; END IF;
+                    IF novo->>'tipo' IS DISTINCT FROM 'PU' THEN novo := NULL; END IF;
+                END IF;
+                IF COALESCE(antigo->>'local', '') = '' THEN antigo := NULL; END IF;
+                IF COALESCE(novo->>'local', '') = '' THEN novo := NULL; END IF;
+
+                IF antigo IS NOT NULL AND novo IS NOT NULL
+                   AND antigo->>'local' = novo->>'local'
+                   AND COALESCE(antigo->>'peca', '') = COALESCE(novo->>'peca', '') THEN
+                    RETURN NULL;
+                END IF;
+
+                IF antigo IS NOT NULL THEN
+                    UPDATE public.pu_local_tipos SET
+                        total = total - 1,
+                        estoque = estoque - (origem = 'estoque')::int,
+                        otimizadas = otimizadas - (origem = 'otimizadas')::int,
+                        manuais = manuais - (origem = 'manuais')::int
+                    WHERE local = antigo->>'local' AND peca = COALESCE(antigo->>'peca', '');
+                    DELETE FROM public.pu_local_tipos
+                    WHERE local = antigo->>'local' AND peca = COALESCE(antigo->>'peca', '') AND total <= 0;
+                END IF;
+                IF novo IS NOT NULL THEN
+                    INSERT INTO public.pu_local_tipos (local, peca, total, estoque, otimizadas, manuais)
+                    VALUES (
+                        novo->>'local', COALESCE(novo->>'peca', ''), 1,
+                        (origem = 'estoque')::int, (origem = 'otimizadas')::int, (origem = 'manuais')::int
+                    )
+                    ON CONFLICT (local, peca) DO UPDATE SET
+                        total = public.pu_local_tipos.total + 1,
+                        estoque = public.pu_local_tipos.estoque + EXCLUDED.estoque,
+                        otimizadas = public.pu_local_tipos.otimizadas + EXCLUDED.otimizadas,
+                        manuais = public.pu_local_tipos.manuais + EXCLUDED.manuais;
+                END IF;
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql
+        """)
+        cur.execute("""
+            CREATE OR REPLACE FUNCTION public.pu_local_tipos_recalcular() RETURNS void AS $$
+            BEGIN
+                DELETE FROM public.pu_local_tipos;
+                INSERT INTO public.pu_local_tipos (local, peca, total, estoque, otimizadas, manuais)
+                SELECT
+                    local, COALESCE(peca, ''), COUNT(*),
+                    COUNT(*) FILTER (WHERE origem = 'estoque'),
+                    COUNT(*) FILTER (WHERE origem = 'otimizadas'),
+                    COUNT(*) FILTER (WHERE origem = 'manuais')
+                FROM (
+                    SELECT local, peca, 'estoque' AS origem FROM public.pu_inventory
+                    UNION ALL
+                    SELECT local, peca, 'otimizadas' FROM public.pu_otimizadas WHERE tipo = 'PU'
+                    UNION ALL
+                    SELECT local, peca, 'manuais' FROM public.pu_manuais
+                ) AS ocupacao
+                WHERE local IS NOT NULL AND local != ''
+                GROUP BY local, COALESCE(peca, '');
+            END;
+            $$ LANGUAGE plpgsql
+        """)
+        # TRUNCATE (truncar_manuais) não dispara gatilhos por linha
+        cur.execute("""
+            CREATE OR REPLACE FUNCTION public.pu_local_tipos_truncate() RETURNS trigger AS $$
+            BEGIN
+                PERFORM public.pu_local_tipos_recalcular();
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql
+        """)
+        for tabela in ('pu_inventory', 'pu_otimizadas', 'pu_manuais'):
+            cur.execute(f"DROP TRIGGER IF EXISTS pu_local_tipos_sync ON public.{tabela}")
+            cur.execute(f"""
+                CREATE TRIGGER pu_local_tipos_sync
+                AFTER INSERT OR UPDATE OR DELETE ON public.{tabela}
+                FOR EACH ROW EXECUTE FUNCTION public.pu_local_tipos_sync()
+            """)
+            cur.execute(f"DROP TRIGGER IF EXISTS pu_local_tipos_truncate ON public.{tabela}")
+            cur.execute(f"""
+                CREATE TRIGGER pu_local_tipos_truncate
+                AFTER TRUNCATE ON public.{tabela}
+                FOR EACH STATEMENT EXECUTE FUNCTION public.pu_local_tipos_truncate()
+            """)
+
+        # Peças no estoque de cada lote VD, mantidas por gatilho em pu_inventory: conferir se o
+        # lote está completo é uma leitura pela chave mais a contagem do lote no plano de corte
+        # (plano_controle_corte_vidro2 é de outro sistema: o app não instala gatilhos nele)
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS public.pu_lotes_contagem (
+                lote_vd TEXT PRIMARY KEY,
+                no_estoque INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+        cur.execute("ALTER TABLE public.pu_lotes_contagem DROP COLUMN IF EXISTS esperadas")
+        cur.execute("""
+            CREATE OR REPLACE FUNCTION public.pu_lotes_contagem_sync() RETURNS trigger AS $$
+            DECLARE
+                antigo text;
+                novo text;
+            BEGIN
+                -- Gatilho antigo que tenha ficado no plano de corte não conta nada
+                IF TG_TABLE_NAME <> 'pu_inventory' THEN
+                    RETURN NULL;
+                END IF;
+                IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                    antigo := NULLIF(OLD.lote_vd, '');
+                END IF;
+                IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                    novo := NULLIF(NEW.lote_vd, '');
+                END IF;
+                IF antigo IS NOT DISTINCT FROM novo THEN
+                    RETURN NULL;
+                END IF;
+
+                IF antigo IS NOT NULL THEN
+                    UPDATE public.pu_lotes_contagem SET no_estoque = no_estoque - 1
+                    WHERE lote_vd = antigo;
+                END IF;
+                IF novo IS NOT NULL THEN
+                    INSERT INTO public.pu_lotes_contagem (lote_vd, no_estoque)
+                    VALUES (novo, 1)
+                    ON CONFLICT (lote_vd) DO UPDATE SET
+                        no_estoque = public.pu_lotes_contagem.no_estoque + 1;
+                END IF;
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql
+        """)
+        cur.execute("""
+            CREATE OR REPLACE FUNCTION public.pu_lotes_contagem_recalcular() RETURNS void AS $$
+            BEGIN
+                DELETE FROM public.pu_lotes_contagem;
+                INSERT INTO public.pu_lotes_contagem (lote_vd, no_estoque)
+                SELECT lote_vd, COUNT(*)
+                FROM public.pu_inventory
+                WHERE lote_vd IS NOT NULL AND lote_vd != ''
+                GROUP BY lote_vd;
+            END;
+            $$ LANGUAGE plpgsql
+        """)
+        cur.execute("""
+            CREATE OR REPLACE FUNCTION public.pu_lotes_contagem_truncate() RETURNS trigger AS $$
+            BEGIN
+                PERFORM public.pu_lotes_contagem_recalcular();
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql
+        """)
+        cur.execute("DROP TRIGGER IF EXISTS pu_lotes_contagem_sync ON public.pu_inventory")
+        cur.execute("""
+            CREATE TRIGGER pu_lotes_contagem_sync
+            AFTER INSERT OR UPDATE OF lote_vd OR DELETE ON public.pu_inventory
+            FOR EACH ROW EXECUTE FUNCTION public.pu_lotes_contagem_sync()
+        """)
+        cur.execute("DROP TRIGGER IF EXISTS pu_lotes_contagem_truncate ON public.pu_inventory")
+        cur.execute("""
+            CREATE TRIGGER pu_lotes_contagem_truncate
+            AFTER TRUNCATE ON public.pu_inventory
+            FOR EACH STATEMENT EXECUTE FUNCTION public.pu_lotes_contagem_truncate()
+        """)
+
+        # Ocupação por local (uma linha por local) lida por todos os endpoints. O "ocupante" é
+        # o tipo de peça do local; locais misturados (legado) mostram o menor tipo.
+        cur.execute("""
+            CREATE OR REPLACE VIEW public.pu_ocupacao AS
+            SELECT
+                local,
+                MIN(peca) AS ocupante,
+                COUNT(*) AS tipos,
+                SUM(estoque)::int AS estoque,
+                SUM(otimizadas)::int AS otimizadas,
+                SUM(manuais)::int AS manuais,
+                SUM(total)::int AS total
+            FROM public.pu_local_tipos
+            GROUP BY local
+        """)
+
+        # Qualquer alteração em pu_camadas (inclusive fora do app) invalida o LayerCatalog
+        cur.execute("""
+            CREATE OR REPLACE FUNCTION public.pu_versoes_avancar() RETURNS trigger AS $$
+            BEGIN
+                INSERT INTO public.pu_versoes (nome, versao) VALUES (TG_ARGV[0], 1)
+                ON CONFLICT (nome) DO UPDATE SET versao = public.pu_versoes.versao + 1;
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql
+        """)
+        # pu_camadas não é criada pelo app: o gatilho só é instalado quando falta, em um
+        # savepoint. Sem permissão, as demais estruturas seguem e o catálogo passa a ser
+        # relido por tempo (CATALOGO_CAMADAS_RECARGA_SEGUNDOS)
+        cur.execute("""
+            SELECT to_regclass('public.pu_camadas') IS NOT NULL,
+                   EXISTS (
+                       SELECT 1 FROM pg_trigger
+                       WHERE tgrelid = to_regclass('public.pu_camadas') AND tgname = 'pu_camadas_versao'
+                   )
+        """)
+        tem_camadas, tem_gatilho_camadas = cur.fetchone()
+        if tem_camadas and not tem_gatilho_camadas:
+            cur.execute("SAVEPOINT pu_camadas_versao")
+            try:
+                cur.execute("""
+                    CREATE TRIGGER pu_camadas_versao
+                    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON public.pu_camadas
+                    FOR EACH STATEMENT EXECUTE FUNCTION public.pu_versoes_avancar('pu_camadas')
+                """)
+                cur.execute("RELEASE SAVEPOINT pu_camadas_versao")
+                tem_gatilho_camadas = True
+            except psycopg2.Error as e:
+                cur.execute("ROLLBACK TO SAVEPOINT pu_camadas_versao")
+                print(f"Aviso: sem gatilho de versão em pu_camadas, catálogo relido a cada {CATALOGO_CAMADAS_RECARGA_SEGUNDOS}s: {e}")
+
+        # Reconstruir o índice com as tabelas travadas contra escrita (corrige qualquer desvio)
+        cur.execute("LOCK TABLE public.pu_inventory, public.pu_otimizadas, public.pu_manuais IN SHARE ROW EXCLUSIVE MODE")
+        cur.execute("SELECT public.pu_local_tipos_recalcular()")
+        cur.execute("SELECT public.pu_lotes_contagem_recalcular()")
+
+        conn.commit()
+        _catalogo_camadas_cache['gatilho'] = tem_gatilho_camadas
+        print("Estruturas de alocação verificadas")
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+def preparar_plano_corte():
+    """Índice de id_lote no plano de corte e remoção dos gatilhos de versões anteriores
+
+    plano_controle_corte_vidro2 é de outro sistema: nada aqui roda na transação das
+    estruturas do app. O catálogo (pg_trigger/pg_index) é consultado antes, então com tudo
+    pronto nenhuma trava é pedida na tabela. Quando falta, o índice é criado com CONCURRENTLY
+    (sem bloquear as escritas do outro sistema) em uma conexão em autocommit. Sem permissão,
+    só avisa: a contagem por lote continua funcionando, apenas sem o índice.
+    """
+    conn = get_db_connection()
+    try:
+        conn.autocommit = True
+        cur = conn.cursor()
+        cur.execute("SELECT to_regclass('public.plano_controle_corte_vidro2')")
+        if cur.fetchone()[0] is None:
+            return
+        
+        cur.execute("""
+            SELECT tgname FROM pg_trigger
+            WHERE tgrelid = 'public.plano_controle_corte_vidro2'::regclass
+              AND tgname IN ('pu_lotes_contagem_sync', 'pu_lotes_contagem_truncate')
+        """)
+        for (gatilho,) in cur.fetchall():
+            cur.execute(f"DROP TRIGGER IF EXISTS {gatilho} ON public.plano_controle_corte_vidro2")
+            print(f"Gatilho antigo {gatilho} removido do plano de corte")
+        
+        # Qualquer índice válido que comece por id_lote serve para a contagem por lote
+        cur.execute("""
+            SELECT 1
+            FROM pg_index i
+            JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = i.indkey[0]
+            WHERE i.indrelid = 'public.plano_controle_corte_vidro2'::regclass
+              AND i.indisvalid AND a.attname = 'id_lote'
+            LIMIT 1
+        """)
+        if cur.fetchone() is None:
+            # CONCURRENTLY interrompido deixa o índice inválido com o nome ocupado: refazer
+            cur.execute("SELECT to_regclass('public.plano_controle_corte_vidro2_id_lote_idx')")
+            if cur.fetchone()[0]:
+                cur.execute("DROP INDEX CONCURRENTLY IF EXISTS public.plano_controle_corte_vidro2_id_lote_idx")
+            print("Criando índice de id_lote no plano de corte...")
+            cur.execute("CREATE INDEX CONCURRENTLY IF NOT EXISTS plano_controle_corte_vidro2_id_lote_idx ON public.plano_controle_corte_vidro2 (id_lote)")
+    except psycopg2.Error as e:
+        print(f"Aviso: plano de corte sem índice de id_lote ou com gatilhos antigos: {e}")
+    finally:
+        conn.close()
+
 # Executar automaticamente na inicialização
 try:
     print("Verificando tabelas...")
     popular_locais_iniciais()
+    preparar_estruturas_alocacao()
+    preparar_plano_corte()
     print("Verificação concluída!")
 except Exception as e:
     print(f"Aviso na inicialização: {e}")
     print("Continuando mesmo assim...")
 
+# Varredura periódica dos lotes completos (LOTES_STATUS_INTERVALO_SEGUNDOS=0 desliga)
+if LOTES_STATUS_INTERVALO_SEGUNDOS > 0:
+    threading.Thread(target=verificar_lotes_periodicamente, daemon=True).start()
+
 @app.route('/api/adicionar-local', methods=['POST'])
 @login_required
 def adicionar_local():
@@ -2637,6 +3728,9 @@ def adicionar_local():
             INSERT INTO public.pu_locais (local, rack, status, nome)
             VALUES (%s, %s, %s, %s)
         """, (local, 'COLMEIA', 'Ativo', nome))
+        
+        # Layout mudou: sequência de preenchimento precisa ser recompilada
+        invalidar_topologia_racks(cur)
 
         conn.commit()
         conn.close()
@@ -2669,6 +3763,9 @@ def alterar_status_local():
         if cur.rowcount == 0:
             conn.close()
             return jsonify({'success': False, 'message': 'Local não encontrado'})
+        
+        # Layout mudou: sequência de preenchimento precisa ser recompilada
+        invalidar_topologia_racks(cur)
 
         conn.commit()
         conn.close()
@@ -2867,6 +3964,7 @@ def gerar_xml():
         zip_buffer = io.BytesIO()
         xmls_gerados = []
         xmls_nao_gerados = []
+        catalogo_camadas = obter_catalogo_camadas(conn)
         
         # Processar em lotes menores para evitar problemas de memória
         batch_size = 20
@@ -2885,67 +3983,15 @@ def gerar_xml():
                     peca_codigo = peca_data['peca']
                     op = peca_data['op']
                 
-                    # Verificar se há peças especiais definidas
-                    cur.execute("""
-                        SELECT pecas_especiais FROM public.pu_camadas
-                        WHERE projeto = %s AND peca = %s AND pecas_especiais IS NOT NULL AND pecas_especiais != ''
-                    """, (projeto, peca_codigo))
-                    
-                    pecas_especiais_result = cur.fetchone()
-                    pecas_para_gerar = [peca_codigo]  # Sempre incluir a peça original
-                    
-                    # Se há peças especiais, usar elas ao invés da peça original
-                    if pecas_especiais_result and pecas_especiais_result['pecas_especiais']:
-                        pecas_especiais = pecas_especiais_result['pecas_especiais'].strip()
-                        if pecas_especiais:
-                            # Dividir por hífen e vírgula, limpar espaços
-                            pecas_para_gerar = [p.strip() for p in pecas_especiais.replace('-', ',').split(',') if p.strip()]
+                    # Peças especiais (se definidas) substituem a peça original
+                    pecas_para_gerar = catalogo_camadas.pecas_para_processar(projeto, peca_codigo)
                     
                     # Para cada peça que deve ser gerada
                     xml_count_peca = 0
                     xmls_gerados_peca = []
                 
                     for peca_atual in pecas_para_gerar:
-                        # Buscar camadas da peça atual na tabela pu_camadas
-                        cur.execute("""
-                            SELECT l1, l3, l3_b FROM public.pu_camadas
-                            WHERE projeto = %s AND peca = %s
-                        """, (projeto, peca_atual))
-                        
-                        camadas_result = cur.fetchone()
-                        camadas_para_gerar = []
-                        
-                        if camadas_result:
-                            l1_value = camadas_result['l1']
-                            l3_value = camadas_result['l3']
-                            l3_b_value = camadas_result.get('l3_b')
-                            
-                            # Verificar L1
-                            if l1_value and l1_value != '-' and str(l1_value).strip():
-                                try:
-                                    qtd_l1 = int(l1_value)
-                                    for _ in range(qtd_l1):
-                                        camadas_para_gerar.append('L1')
-                                except:
-                                    camadas_para_gerar.append('L1')
-                            
-                            # Verificar L3
-                            if l3_value and l3_value != '-' and str(l3_value).strip():
-                                try:
-                                    qtd_l3 = int(l3_value)
-                                    for _ in range(qtd_l3):
-                                        camadas_para_gerar.append('L3')
-                                except:
-                                    camadas_para_gerar.append('L3')
-                            
-                            # Verificar L3_B
-                            if l3_b_value and l3_b_value != '-' and str(l3_b_value).strip():
-                                try:
-                                    qtd_l3_b = int(l3_b_value)
-                                    for _ in range(qtd_l3_b):
-                                        camadas_para_gerar.append('L3_B')
-                                except:
-                                    camadas_para_gerar.append('L3_B')
+                        camadas_para_gerar = catalogo_camadas.camadas(projeto, peca_atual)
                         
                         # Se não encontrou camadas para esta peça, pular
                         if not camadas_para_gerar:
@@ -3177,52 +4223,11 @@ def gerar_excel_otimizacao():
         
         # Adicionar coluna quantidade baseada nas camadas
         conn = get_db_connection()
-        cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        catalogo_camadas = obter_catalogo_camadas(conn)
         
         for item in dados:
-            projeto = item.get('projeto', '')
-            peca = item.get('peca', '')
-            
-            # Buscar camadas da peça na tabela pu_camadas
-            cur.execute("""
-                SELECT l1, l3, l3_b FROM public.pu_camadas
-                WHERE projeto = %s AND peca = %s
-            """, (projeto, peca))
-            
-            camadas_result = cur.fetchone()
-            quantidade_total = 0
-            
-            if camadas_result:
-                l1_value = camadas_result['l1']
-                l3_value = camadas_result['l3']
-                l3_b_value = camadas_result.get('l3_b')
-                
-                # Contar L1
-                if l1_value and l1_value != '-' and str(l1_value).strip():
-                    try:
-                        quantidade_total += int(l1_value)
-                    except:
-                        quantidade_total += 1
-                
-                # Contar L3
-                if l3_value and l3_value != '-' and str(l3_value).strip():
-                    try:
-                        quantidade_total += int(l3_value)
-                    except:
-                        quantidade_total += 1
-                
-                # Contar L3_B
-                if l3_b_value and l3_b_value != '-' and str(l3_b_value).strip():
-                    try:
-                        quantidade_total += int(l3_b_value)
-                    except:
-                        quantidade_total += 1
-            
-            # Se não encontrou camadas, quantidade = 1
-            if quantidade_total == 0:
-                quantidade_total = 1
-            
-            item['quantidade'] = quantidade_total
+            # Quantidade = número de camadas; se não encontrou camadas, quantidade = 1
+            item['quantidade'] = len(catalogo_camadas.camadas(item.get('projeto', ''), item.get('peca', ''))) or 1
         
         conn.close()
         
@@ -3570,15 +4575,7 @@ def api_locais_disponiveis():
         total_locais = cur.fetchone()[0]
         
         # Contar locais ocupados
-        cur.execute("""
-            SELECT COUNT(DISTINCT local) FROM (
-                SELECT local FROM public.pu_inventory WHERE local IS NOT NULL AND local != ''
-                UNION
-                SELECT local FROM public.pu_otimizadas WHERE tipo = 'PU' AND local IS NOT NULL AND local != ''
-                UNION
-                SELECT local FROM public.pu_manuais WHERE local IS NOT NULL AND local != ''
-            ) AS occupied
-        """)
+        cur.execute("SELECT COUNT(*) FROM public.pu_ocupacao")
         locais_ocupados = cur.fetchone()[0]
         
         locais_disponiveis = total_locais - locais_ocupados
@@ -3629,6 +4626,96 @@ def buscar_op(op):
             'message': f'Erro ao buscar OP: {str(e)}'
         }), 500
 
+# Linhas por lote na leitura em streaming das planilhas enviadas
+LINHAS_POR_LOTE_XLSX = 2000
+
+def ler_planilha_em_lotes(arquivo, linhas_por_lote=LINHAS_POR_LOTE_XLSX):
+    """Lê a primeira aba de um .xlsx em modo read-only do openpyxl, em DataFrames de até
+    `linhas_por_lote` linhas
+
+    A primeira linha é o cabeçalho. O índice de cada DataFrame é a posição da linha entre os
+    dados (como no pd.read_excel), então a linha da planilha é índice + 2. Linhas totalmente
+    em branco no meio dos dados entram no lote (o upload as aponta como campos em branco);
+    as do fim da aba são descartadas, como no pd.read_excel. Só um lote fica em memória por vez.
+    """
+    workbook = openpyxl.load_workbook(arquivo, read_only=True, data_only=True)
+    try:
+        linhas = workbook.worksheets[0].iter_rows(values_only=True)
+        cabecalho = next(linhas, None)
+        if cabecalho is None:
+            return
+        colunas = [str(valor).strip() if valor is not None else f'Unnamed: {i}' for i, valor in enumerate(cabecalho)]
+        
+        lote, indices = [], []
+        em_branco = []
+        for indice, valores in enumerate(linhas):
+            valores = tuple(valores[:len(colunas)]) + (None,) * (len(colunas) - len(valores))
+            # Linhas em branco só entram quando aparece uma linha com dados depois delas
+            if all(valor is None for valor in valores):
+                em_branco.append((indice, valores))
+                continue
+            for indice_linha, valores_linha in em_branco + [(indice, valores)]:
+                lote.append(valores_linha)
+                indices.append(indice_linha)
+                if len(lote) >= linhas_por_lote:
+                    yield pd.DataFrame(lote, columns=colunas, index=indices)
+                    lote, indices = [], []
+            em_branco = []
+        if lote:
+            yield pd.DataFrame(lote, columns=colunas, index=indices)
+    finally:
+        workbook.close()
+
+def mapear_colunas_upload(colunas, colunas_obrigatorias):
+    """Coluna da planilha para cada coluna obrigatória (case insensitive, por trecho do nome)
+
+    Retorna (mapeamento, coluna_faltando); coluna_faltando é None quando todas foram achadas.
+    """
+    colunas_arquivo = [str(col).lower().strip() for col in colunas]
+    mapeamento_colunas = {}
+    for col_obrig in colunas_obrigatorias:
+        for i, col_arq in enumerate(colunas_arquivo):
+            if col_obrig in col_arq or col_arq in col_obrig:
+                mapeamento_colunas[col_obrig] = colunas[i]
+                break
+        else:
+            return mapeamento_colunas, col_obrig
+    return mapeamento_colunas, None
+
+def limpar_coluna_planilha(serie):
+    """Limpeza vetorizada das células do upload: texto sem espaços nas pontas, vazio para
+    célula em branco e sem o '.0' que o Excel acrescenta aos números inteiros"""
+    valores = serie.astype(object).where(serie.notna(), '').astype(str).str.strip()
+    return valores.str.replace(r'^(?=[\d-]*\d)([\d-]+)\.0$', r'\1', regex=True)
+
+def montar_planilha_upload(df, mapeamento_colunas):
+    """Colunas limpas do upload (linha da planilha, op, peca, projeto, veiculo, sensor)"""
+    planilha = pd.DataFrame({'linha': df.index + 2})
+    for coluna in ['op', 'peca', 'projeto', 'veiculo']:
+        planilha[coluna] = limpar_coluna_planilha(df[mapeamento_colunas[coluna]]).values
+    # Sensor é opcional
+    planilha['sensor'] = limpar_coluna_planilha(df['sensor']).values if 'sensor' in df.columns else ''
+    return planilha
+
+def copiar_planilha_staging(cur, planilha):
+    """COPY das linhas limpas para a tabela temporária pu_upload_staging (criada se preciso)"""
+    cur.execute("""
+        CREATE TEMP TABLE IF NOT EXISTS pu_upload_staging (
+            linha INTEGER PRIMARY KEY,
+            op TEXT NOT NULL,
+            peca TEXT NOT NULL,
+            projeto TEXT NOT NULL,
+            veiculo TEXT NOT NULL,
+            sensor TEXT
+        ) ON COMMIT DROP
+    """)
+    buffer = io.StringIO()
+    planilha.to_csv(buffer, index=False, header=False)
+    buffer.seek(0)
+    cur.copy_expert("""
+        COPY pu_upload_staging (linha, op, peca, projeto, veiculo, sensor) FROM STDIN WITH (FORMAT csv)
+    """, buffer)
+
 @app.route('/api/upload-xlsx', methods=['POST'])
 @login_required
 def upload_xlsx():
@@ -3643,158 +4730,100 @@ def upload_xlsx():
         if not file.filename.lower().endswith('.xlsx'):
             return jsonify({'success': False, 'message': 'Apenas arquivos .xlsx são aceitos'}), 400
         
-        # Ler arquivo Excel
-        df = pd.read_excel(file, engine='openpyxl')
-        
-        if df.empty:
-            return jsonify({'success': False, 'message': 'Arquivo vazio'}), 400
-        
-        # Verificar se tem as colunas obrigatórias (case insensitive)
         colunas_obrigatorias = ['op', 'peca', 'projeto', 'veiculo']
-        colunas_arquivo = [col.lower().strip() for col in df.columns]
-        
-        # Mapear colunas do arquivo
-        mapeamento_colunas = {}
-        for col_obrig in colunas_obrigatorias:
-            encontrada = False
-            for i, col_arq in enumerate(colunas_arquivo):
-                if col_obrig in col_arq or col_arq in col_obrig:
-                    mapeamento_colunas[col_obrig] = df.columns[i]
-                    encontrada = True
-                    break
-            if not encontrada:
-                return jsonify({'success': False, 'message': f'Coluna "{col_obrig}" não encontrada no arquivo'}), 400
+        conn = None
         
-        conn = get_db_connection()
-        cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        pecas_processadas = []
+        erros_por_linha = []
+        
+        # Planilha lida em streaming: cada lote é limpo (vetorizado) e vai por COPY para a tabela
+        # temporária enquanto o próximo ainda está sendo lido
+        for df in ler_planilha_em_lotes(file):
+            if conn is None:
+                # Verificar se tem as colunas obrigatórias (case insensitive)
+                mapeamento_colunas, coluna_faltando = mapear_colunas_upload(list(df.columns), colunas_obrigatorias)
+                if coluna_faltando:
+                    return jsonify({'success': False, 'message': f'Coluna "{coluna_faltando}" não encontrada no arquivo'}), 400
+                
+                conn = get_db_connection()
+                cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+            
+            # Linhas com campo obrigatório em branco ficam de fora
+            planilha = montar_planilha_upload(df, mapeamento_colunas)
+            em_branco = (planilha[colunas_obrigatorias] == '').any(axis=1)
+            for linha in planilha.loc[em_branco, 'linha']:
+                erros_por_linha.append((linha, f'Linha {linha}: Campos obrigatórios em branco'))
+            
+            # As demais vão para a tabela temporária, e as verificações rodam sobre ela
+            copiar_planilha_staging(cur, planilha[~em_branco])
         
-        # Buscar locais ocupados
-        cur.execute("""
-            SELECT local FROM public.pu_inventory WHERE local IS NOT NULL AND local != '' 
-            UNION 
-            SELECT local FROM public.pu_otimizadas WHERE tipo = 'PU' AND local IS NOT NULL AND local != ''
-            UNION
-            SELECT local FROM public.pu_manuais WHERE local IS NOT NULL AND local != ''
+        if conn is None:
+            return jsonify({'success': False, 'message': 'Arquivo vazio'}), 400
+        
+        # Peças já existentes no sistema ou repetidas na própria planilha, e o arquivo de cada peça
+        cur.execute(f"""
+            SELECT p.linha, p.op, p.peca, p.projeto, p.veiculo, COALESCE(p.sensor, '') AS sensor,
+                   row_number() OVER (PARTITION BY p.op, p.peca ORDER BY p.linha) > 1
+                       OR {PECA_JA_EXISTE_SQL} AS existente,
+                   COALESCE(CASE
+                       WHEN p.peca = 'PBS' AND COALESCE(p.sensor, '') <> '' THEN (
+                           SELECT a.nome_peca FROM public.arquivos_pu a
+                           WHERE a.projeto = p.projeto AND a.peca = p.peca AND a.sensor = p.sensor
+                           LIMIT 1)
+                       ELSE (
+                           SELECT a.nome_peca FROM public.arquivos_pu a
+                           WHERE a.projeto = p.projeto AND a.peca = p.peca
+                           LIMIT 1)
+                   END, 'Sem arquivo') AS arquivo
+            FROM pu_upload_staging p
+            ORDER BY p.linha
         """)
-        locais_ocupados = {row['local'] for row in cur.fetchall()}
+        pecas_validas = []
+        for row in cur.fetchall():
+            if row['existente']:
+                erros_por_linha.append((row['linha'], f'Linha {row["linha"]}: Peça {row["peca"]} com OP {row["op"]} já existe'))
+            else:
+                pecas_validas.append(row)
         
-        pecas_processadas = []
-        pecas_com_erro = []
-        locais_usados_nesta_sessao = set()
+        # Alocar locais de todas as linhas válidas de uma vez
+        alocacoes, sem_local = alocar_locais_lote(
+            conn,
+            [(row['op'], row['peca'], row['projeto']) for row in pecas_validas],
+            estrategia=request.form.get('estrategia', '')
+        )
+        lotes = resolver_lotes(cur, [(row['op'], row['peca']) for row in pecas_validas])
         
-        for index, row in df.iterrows():
-            try:
-                # Função para limpar valores
-                def limpar_valor(valor):
-                    if pd.notna(valor):
-                        valor_str = str(valor).strip()
-                        # Remover .0 se for um número inteiro
-                        if valor_str.endswith('.0') and valor_str.replace('.0', '').replace('-', '').isdigit():
-                            valor_str = valor_str[:-2]
-                        return valor_str
-                    return ''
-                
-                # Usar mapeamento de colunas com limpeza
-                op = limpar_valor(row[mapeamento_colunas['op']])
-                peca = limpar_valor(row[mapeamento_colunas['peca']])
-                projeto = limpar_valor(row[mapeamento_colunas['projeto']])
-                veiculo = limpar_valor(row[mapeamento_colunas['veiculo']])
-                
-                # Sensor é opcional
-                sensor = ''
-                if 'sensor' in df.columns:
-                    sensor = limpar_valor(row.get('sensor', ''))
-                
-                if not all([op, peca, projeto, veiculo]):
-                    pecas_com_erro.append(f'Linha {index+2}: Campos obrigatórios em branco')
-                    continue
-                
-                # Verificar se peça já existe
-                cur.execute("""
-                    SELECT COUNT(*) FROM (
-                        SELECT 1 FROM public.pu_inventory WHERE op = %s AND peca = %s
-                        UNION ALL
-                        SELECT 1 FROM public.pu_otimizadas WHERE op = %s AND peca = %s AND tipo = 'PU'
-                        UNION ALL
-                        SELECT 1 FROM public.pu_manuais WHERE op = %s AND peca = %s
-                    ) AS existing
-                """, (op, peca, op, peca, op, peca))
-                
-                if cur.fetchone()[0] > 0:
-                    pecas_com_erro.append(f'Linha {index+2}: Peça {peca} com OP {op} já existe')
-                    continue
-                
-                # Combinar locais ocupados com os já usados nesta sessão
-                locais_bloqueados = locais_ocupados | locais_usados_nesta_sessao
-                
-                # Buscar locais que já têm peças diferentes do tipo atual
-                cur.execute("""
-                    SELECT DISTINCT local FROM public.pu_inventory 
-                    WHERE peca != %s AND local IS NOT NULL AND local != ''
-                    UNION
-                    SELECT DISTINCT local FROM public.pu_otimizadas 
-                    WHERE peca != %s AND tipo = 'PU' AND local IS NOT NULL AND local != ''
-                    UNION
-                    SELECT DISTINCT local FROM public.pu_manuais 
-                    WHERE peca != %s AND local IS NOT NULL AND local != ''
-                """, (peca, peca, peca))
-                locais_com_pecas_diferentes = {row['local'] for row in cur.fetchall()}
-                
-                # Combinar todos os locais bloqueados
-                locais_bloqueados = locais_bloqueados | locais_com_pecas_diferentes
-                
-                # Sugerir local
-                local_sugerido, rack_sugerido = sugerir_local_armazenamento(peca, locais_bloqueados, conn)
-                
-                if not local_sugerido or not rack_sugerido:
-                    pecas_com_erro.append(f'Linha {index+2}: Não há locais disponíveis para peça {peca}')
-                    continue
-                
-                # Buscar arquivo baseado no projeto, peça e sensor
-                arquivo_status = "Sem arquivo"
-                if peca == 'PBS' and sensor:
-                    cur.execute("""
-                        SELECT nome_peca FROM public.arquivos_pu
-                        WHERE projeto = %s AND peca = %s AND sensor = %s
-                        LIMIT 1
-                    """, (projeto, peca, sensor))
-                    arquivo_result = cur.fetchone()
-                    if arquivo_result:
-                        arquivo_status = arquivo_result['nome_peca']
-                else:
-                    cur.execute("""
-                        SELECT nome_peca FROM public.arquivos_pu
-                        WHERE projeto = %s AND peca = %s
-                        LIMIT 1
-                    """, (projeto, peca))
-                    arquivo_result = cur.fetchone()
-                    if arquivo_result:
-                        arquivo_status = arquivo_result['nome_peca']
-                
-                # Inserir na tabela pu_manuais
-                cur.execute("""
-                    INSERT INTO public.pu_manuais (op, peca, projeto, veiculo, local, rack, arquivo, usuario)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-                """, (op, peca, projeto, veiculo, local_sugerido, rack_sugerido, arquivo_status, current_user.username))
-                
-                # Adicionar aos processados
-                pecas_processadas.append({
-                    'op': op,
-                    'peca': peca,
-                    'projeto': projeto,
-                    'veiculo': veiculo,
-                    'local': local_sugerido,
-                    'rack': rack_sugerido,
-                    'sensor': sensor,
-                    'arquivo_status': arquivo_status
-                })
-                
-                # Marcar local como usado
-                locais_usados_nesta_sessao.add(local_sugerido)
-                
-            except Exception as row_error:
-                pecas_com_erro.append(f'Linha {index+2}: Erro - {str(row_error)}')
+        alocadas = []
+        for row, alocacao in zip(pecas_validas, alocacoes):
+            if alocacao['local'] == 'SEM LOCAL':
+                erros_por_linha.append((row['linha'], f'Linha {row["linha"]}: Não há locais disponíveis para peça {row["peca"]}'))
                 continue
+            lote_vd, lote_pu = lotes.get((row['op'], row['peca']), ('', ''))
+            alocadas.append((row['linha'], alocacao['local'], alocacao['rack'], row['arquivo'], lote_vd, lote_pu))
+            pecas_processadas.append({
+                'op': row['op'],
+                'peca': row['peca'],
+                'projeto': row['projeto'],
+                'veiculo': row['veiculo'],
+                'local': alocacao['local'],
+                'rack': alocacao['rack'],
+                'sensor': row['sensor'],
+                'arquivo_status': row['arquivo']
+            })
+        
+        # Inserir na tabela pu_manuais todas as linhas alocadas em um único INSERT ... SELECT
+        if alocadas:
+            colunas = list(zip(*alocadas))
+            cur.execute("""
+                INSERT INTO public.pu_manuais (op, peca, projeto, veiculo, local, rack, arquivo, usuario, lote_vd, lote_pu, sensor)
+                SELECT p.op, p.peca, p.projeto, p.veiculo, a.local, a.rack, a.arquivo, %s, a.lote_vd, a.lote_pu, COALESCE(p.sensor, '')
+                FROM pu_upload_staging p
+                JOIN unnest(%s::int[], %s::text[], %s::text[], %s::text[], %s::text[], %s::text[])
+                    AS a(linha, local, rack, arquivo, lote_vd, lote_pu) USING (linha)
+            """, (current_user.username, *[list(coluna) for coluna in colunas]))
+        
+        # Manter os erros na ordem das linhas da planilha
+        pecas_com_erro = [mensagem for _, mensagem in sorted(erros_por_linha, key=lambda erro: erro[0])]
         
         # Log da ação
         cur.execute("""
@@ -3871,26 +4900,8 @@ def verificar_status_lotes():
     """Verifica e atualiza o status de todos os lotes que podem estar completos"""
     try:
         conn = get_db_connection()
-        cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-        
-        # Buscar todos os lotes que não estão marcados como CORTADO
-        cur.execute("""
-            SELECT DISTINCT id_lote 
-            FROM public.plano_controle_corte_vidro2 
-            WHERE (pu_cortado IS NULL OR pu_cortado != 'CORTADO')
-            AND status = 'PROGRAMADO'
-        """)
-        lotes_pendentes = cur.fetchall()
-        
-        lotes_atualizados = []
-        
-        for lote_row in lotes_pendentes:
-            lote_vd = lote_row['id_lote']
-            lote_pu = 'PU' + lote_vd[2:] if len(lote_vd) >= 2 else lote_vd
-            
-            if verificar_e_atualizar_status_lote(lote_vd, lote_pu, cur):
-                lotes_atualizados.append(lote_vd)
-        
+        cur = conn.cursor()
+        lotes_atualizados = atualizar_lotes_cortados(cur)
         conn.commit()
         conn.close()
         
@@ -4003,15 +5014,7 @@ def sugerir_local_voltar():
         
         if local_anterior:
             # Verificar se local anterior está vazio
-            cur.execute("""
-                SELECT COUNT(*) FROM (
-                    SELECT 1 FROM public.pu_inventory WHERE local = %s
-                    UNION ALL
-                    SELECT 1 FROM public.pu_otimizadas WHERE local = %s AND tipo = 'PU'
-                    UNION ALL
-                    SELECT 1 FROM public.pu_manuais WHERE local = %s
-                ) AS occupied
-            """, (local_anterior, local_anterior, local_anterior))
+            cur.execute("SELECT COUNT(*) FROM public.pu_ocupacao WHERE local = %s", (local_anterior,))
             
             if cur.fetchone()[0] == 0:
                 cur.execute("""
@@ -4024,17 +5027,8 @@ def sugerir_local_voltar():
         
         # Se local anterior não disponível, sugerir novo
         if not local_anterior_disponivel:
-            # Buscar locais ocupados
-            cur.execute("""
-                SELECT local FROM public.pu_inventory WHERE local IS NOT NULL AND local != '' 
-                UNION 
-                SELECT local FROM public.pu_otimizadas WHERE tipo = 'PU' AND local IS NOT NULL AND local != ''
-                UNION
-                SELECT local FROM public.pu_manuais WHERE local IS NOT NULL AND local != ''
-            """)
-            locais_ocupados = {row['local'] for row in cur.fetchall()}
-            
-            local_sugerido, rack_sugerido = sugerir_local_armazenamento(peca, locais_ocupados, conn)
+            # O alocador já bloqueia todos os locais ocupados (lidos de pu_local_tipos)
+            local_sugerido, rack_sugerido = sugerir_local_armazenamento(peca, None, conn)
             conn.close()
             
             if local_sugerido:
@@ -4674,17 +5668,7 @@ def voltar_peca_estoque():
         cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
         
         # Verificar se peça já existe no sistema (dupla verificação)
-        cur.execute("""
-            SELECT COUNT(*) FROM (
-                SELECT 1 FROM public.pu_inventory WHERE op = %s AND peca = %s
-                UNION ALL
-                SELECT 1 FROM public.pu_otimizadas WHERE op = %s AND peca = %s AND tipo = 'PU'
-                UNION ALL
-                SELECT 1 FROM public.pu_manuais WHERE op = %s AND peca = %s
-            ) AS existing
-        """, (op, peca, op, peca, op, peca))
-        
-        if cur.fetchone()[0] > 0:
+        if pecas_ja_existentes(cur, [(op, peca)]):
             conn.close()
             return jsonify({'success': False, 'message': f'Peça {peca} com OP {op} já existe no sistema'})
         
@@ -4706,15 +5690,7 @@ def voltar_peca_estoque():
         
         if local_anterior:
             # Verificar se local está vazio no estoque e otimizadas
-            cur.execute("""
-                SELECT COUNT(*) FROM (
-                    SELECT 1 FROM public.pu_inventory WHERE local = %s
-                    UNION ALL
-                    SELECT 1 FROM public.pu_otimizadas WHERE local = %s AND tipo = 'PU'
-                    UNION ALL
-                    SELECT 1 FROM public.pu_manuais WHERE local = %s
-                ) AS occupied
-            """, (local_anterior, local_anterior, local_anterior))
+            cur.execute("SELECT COUNT(*) FROM public.pu_ocupacao WHERE local = %s", (local_anterior,))
             
             if cur.fetchone()[0] == 0:
                 # Local está vazio, pode usar
@@ -4731,81 +5707,23 @@ def voltar_peca_estoque():
         
         # Se não conseguiu usar o local anterior, sugerir novo local
         if not local_sugerido:
-            # Buscar todos os locais ocupados
-            cur.execute("""
-                SELECT local FROM public.pu_inventory WHERE local IS NOT NULL AND local != '' 
-                UNION 
-                SELECT local FROM public.pu_otimizadas WHERE tipo = 'PU' AND local IS NOT NULL AND local != ''
-                UNION
-                SELECT local FROM public.pu_manuais WHERE local IS NOT NULL AND local != ''
-            """)
-            locais_ocupados = {row['local'] for row in cur.fetchall()}
-            
-            # Sugerir novo local
-            local_sugerido, rack_sugerido = sugerir_local_armazenamento(peca, locais_ocupados, conn)
+            # Sugerir novo local (o alocador já bloqueia todos os locais ocupados)
+            local_sugerido, rack_sugerido = sugerir_local_armazenamento(peca, None, conn)
             local_eh_novo = True  # É um novo local
         
         if not local_sugerido or not rack_sugerido:
             conn.close()
             return jsonify({'success': False, 'message': 'Não há locais disponíveis para esta peça'})
         
-        # Buscar camadas da peça na tabela pu_camadas
-        cur.execute("""
-            SELECT l1, l3, l3_b FROM public.pu_camadas
-            WHERE projeto = %s AND peca = %s
-        """, (projeto, peca))
-        
-        camadas_result = cur.fetchone()
-        camadas_para_inserir = []
-        
-        if camadas_result:
-            l1_value = camadas_result['l1']
-            l3_value = camadas_result['l3']
-            l3_b_value = camadas_result.get('l3_b')
-            
-            # Verificar L1
-            if l1_value and l1_value != '-' and str(l1_value).strip():
-                try:
-                    qtd_l1 = int(l1_value)
-                    for _ in range(qtd_l1):
-                        camadas_para_inserir.append('L1')
-                except:
-                    camadas_para_inserir.append('L1')
-            
-            # Verificar L3
-            if l3_value and l3_value != '-' and str(l3_value).strip():
-                try:
-                    qtd_l3 = int(l3_value)
-                    for _ in range(qtd_l3):
-                        camadas_para_inserir.append('L3')
-                except:
-                    camadas_para_inserir.append('L3')
-            
-            # Verificar L3_B
-            if l3_b_value and l3_b_value != '-' and str(l3_b_value).strip():
-                try:
-                    qtd_l3_b = int(l3_b_value)
-                    for _ in range(qtd_l3_b):
-                        camadas_para_inserir.append('L3_B')
-                except:
-                    camadas_para_inserir.append('L3_B')
+        # Camadas da peça (catálogo de pu_camadas em memória)
+        camadas_para_inserir = obter_catalogo_camadas(conn).camadas(projeto, peca)
         
         # Se não encontrou camadas, inserir sem camada
         if not camadas_para_inserir:
             camadas_para_inserir = [None]
         
         # Buscar lote da peça na tabela plano_controle_corte_vidro2
-        lote_vd = ''
-        lote_pu = ''
-        cur.execute("""
-            SELECT id_lote FROM public.plano_controle_corte_vidro2
-            WHERE op = %s AND peca = %s
-            LIMIT 1
-        """, (op, peca))
-        lote_result = cur.fetchone()
-        if lote_result and lote_result['id_lote']:
-            lote_vd = lote_result['id_lote']
-            lote_pu = 'PU' + lote_vd[2:] if len(lote_vd) >= 2 else lote_vd
+        lote_vd, lote_pu = resolver_lotes(cur, [(op, peca)]).get((op, peca), ('', ''))
         
         # Inserir peças no estoque com as camadas
         total_inseridas = 0
@@ -4822,7 +5740,7 @@ def voltar_peca_estoque():
         
         # Verificar e atualizar status do lote
         if lote_vd:
-            verificar_e_atualizar_status_lote(lote_vd, lote_pu, cur)
+            verificar_e_atualizar_status_lote(lote_vd, cur)
         
         # Log da ação
         cur.execute("""
@@ -4865,7 +5783,6 @@ def voltar_peca_estoque():
 if __name__ == '__main__':
     import subprocess
     import threading
-    import time
     
     def iniciar_dashboard():
         """Inicia o dashboard em thread separada"""
@@ -0,0 +1,310 @@
+"""Benchmark do motor de alocação de locais contra um PostgreSQL local.
+
+Monta um banco descartável com os racks do layout atual (RACK1/2/3, colunas A-M,
+números 1-84: 1.092 locais em public.pu_locais), ocupa uma fração dos locais com uma
+mistura de estoque / otimizadas / manuais e mede, para cada nível de ocupação:
+
+- `sugerir_local_armazenamento` chamado peça a peça;
+- `alocar_locais_lote` para um lote inteiro;
+- GET /api/dados de um lote sintético (ponta a ponta, pelo test client do Flask);
+- POST /api/upload-xlsx com uma planilha sintética (ponta a ponta).
+
+O relatório mostra alocações por segundo e consultas SQL por alocação, para comparar
+mudanças no alocador com números.
+
+Uso (na pasta do app, o .env é lido mas as opções abaixo têm prioridade):
+
+    python benchmark_alocacao.py --banco app_pu_bench --ocupacao 0.1 0.5 0.9
+
+O banco informado em --banco é APAGADO e recriado; só hosts locais são aceitos.
+"""
+from __future__ import annotations
+
+import argparse
+import io
+import os
+import random
+import sys
+import time
+from dataclasses import dataclass
+
+import psycopg2
+import psycopg2.extensions
+
+LETRAS = 'ABCDEFGHIJKLM'
+RACKS = {'RACK1': range(1, 29), 'RACK2': range(29, 57), 'RACK3': range(57, 85)}
+TIPOS_PECA = ['PBS', 'TSP', 'PBD', 'VGE', 'VGD', 'TSO']
+HOSTS_LOCAIS = {'localhost', '127.0.0.1', '::1'}
+LOTE_BENCH = 'VDBENCH'
+
+
+class ContadorConsultas:
+    """Conta as chamadas execute/executemany de todas as conexões do benchmark."""
+
+    total = 0
+
+    @classmethod
+    def zerar(cls):
+        cls.total = 0
+
+
+_cursores_contados = {}
+
+
+def _cursor_contado(base):
+    """Subclasse do cursor original (DictCursor, etc.) que incrementa o contador."""
+    if base not in _cursores_contados:
+        class CursorContado(base):
+            def execute(self, query, vars=None):
+                ContadorConsultas.total += 1
+                return super().execute(query, vars)
+
+            def executemany(self, query, vars_list):
+                ContadorConsultas.total += 1
+                return super().executemany(query, vars_list)
+
+        _cursores_contados[base] = CursorContado
+    return _cursores_contados[base]
+
+
+class ConexaoContada(psycopg2.extensions.connection):
+    def cursor(self, *args, **kwargs):
+        base = kwargs.pop('cursor_factory', None) or self.cursor_factory or psycopg2.extensions.cursor
+        kwargs['cursor_factory'] = _cursor_contado(base)
+        return super().cursor(*args, **kwargs)
+
+
+@dataclass
+class Resultado:
+    cenario: str
+    ocupacao: float
+    alocacoes: int
+    segundos: float
+    consultas: int
+
+    @property
+    def por_segundo(self):
+        return self.alocacoes / self.segundos if self.segundos else 0.0
+
+    @property
+    def consultas_por_alocacao(self):
+        return self.consultas / self.alocacoes if self.alocacoes else float(self.consultas)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', default=os.getenv('DB_PORT', '5432'))
+    parser.add_argument('--usuario', default=os.getenv('DB_USER', 'postgres'))
+    parser.add_argument('--senha', default=os.getenv('DB_PSW', ''))
+    parser.add_argument('--banco', default='app_pu_bench', help='Banco descartável (será recriado)')
+    parser.add_argument('--ocupacao', type=float, nargs='+', default=[0.1, 0.5, 0.9],
+                        help='Frações de locais ocupados a medir')
+    parser.add_argument('--mistura', default='60,30,10',
+                        help='Proporção estoque,otimizadas,manuais dos locais ocupados')
+    parser.add_argument('--pecas', type=int, default=100, help='Peças por lote/planilha')
+    parser.add_argument('--sugestoes', type=int, default=50,
+                        help='Chamadas de sugerir_local_armazenamento por cenário')
+    parser.add_argument('--seed', type=int, default=42)
+    return parser.parse_args(argv)
+
+
+def recriar_banco(args):
+    if args.host not in HOSTS_LOCAIS:
+        raise SystemExit(f'Host {args.host} recusado: o benchmark só roda contra um PostgreSQL local.')
+
+    conn = psycopg2.connect(host=args.host, port=args.port, user=args.usuario,
+                            password=args.senha, dbname='postgres')
+    conn.autocommit = True
+    cur = conn.cursor()
+    cur.execute(f'DROP DATABASE IF EXISTS "{args.banco}"')
+    cur.execute(f'CREATE DATABASE "{args.banco}"')
+    conn.close()
+
+
+def criar_esquema(conn):
+    """Tabelas que o app espera encontrar prontas (as demais ele mesmo cria)."""
+    cur = conn.cursor()
+    cur.execute("""
+        CREATE TABLE public.users (
+            id SERIAL PRIMARY KEY, usuario TEXT, senha TEXT, funcao TEXT, setor TEXT, sistema TEXT
+        );
+        CREATE TABLE public.pu_locais (
+            id SERIAL PRIMARY KEY, local TEXT, rack TEXT, status TEXT DEFAULT 'Ativo', nome TEXT
+        );
+        CREATE TABLE public.pu_inventory (
+            id SERIAL PRIMARY KEY, op_pai TEXT, op TEXT, peca TEXT, projeto TEXT, veiculo TEXT,
+            local TEXT, rack TEXT, data TIMESTAMP DEFAULT CURRENT_TIMESTAMP, usuario TEXT,
+            camada TEXT, lote_vd TEXT, lote_pu TEXT
+        );
+        CREATE TABLE public.pu_logs (
+            id SERIAL PRIMARY KEY, usuario TEXT, acao TEXT, detalhes TEXT,
+            data_acao TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        CREATE TABLE public.arquivos_pu (
+            id SERIAL PRIMARY KEY, projeto TEXT, peca TEXT, nome_peca TEXT, sensor TEXT
+        );
+        CREATE TABLE public.plano_controle_corte_vidro2 (
+            id SERIAL PRIMARY KEY, op TEXT, peca TEXT, projeto TEXT, veiculo TEXT, id_lote TEXT,
+            status TEXT, pu_cortado TEXT, etapa_baixa TEXT,
+            data_programacao DATE DEFAULT CURRENT_DATE, turno_programacao TEXT
+        );
+    """)
+    cur.execute("INSERT INTO public.users (usuario, senha, funcao, setor, sistema) VALUES ('bench', '', 'admin', 'T.I', 'PU') RETURNING id")
+    usuario_id = cur.fetchone()[0]
+
+    for rack, numeros in RACKS.items():
+        for num in numeros:
+            for letra in LETRAS:
+                cur.execute("INSERT INTO public.pu_locais (local, rack, status, nome) VALUES (%s, 'COLMEIA', 'Ativo', %s)",
+                            (f'{letra}{num}', rack))
+    conn.commit()
+    return usuario_id
+
+
+def ocupar(conn, fracao, mistura, rng):
+    """Limpa as tabelas de peças (inclusive o que o upload anterior gravou) e as reservas
+    da tela de coleta, e ocupa `fracao` dos locais com a mistura pedida."""
+    cur = conn.cursor()
+    cur.execute("DELETE FROM public.pu_inventory")
+    cur.execute("DELETE FROM public.pu_otimizadas")
+    cur.execute("DELETE FROM public.pu_manuais")
+    cur.execute("DELETE FROM public.pu_reservas_locais")
+    cur.execute("SELECT local FROM public.pu_locais")
+    locais = [row[0] for row in cur.fetchall()]
+    ocupados = rng.sample(locais, int(len(locais) * fracao))
+
+    pesos = [int(p) for p in mistura.split(',')]
+    for i, local in enumerate(ocupados):
+        origem = rng.choices(['estoque', 'otimizadas', 'manuais'], weights=pesos)[0]
+        peca = rng.choice(TIPOS_PECA)
+        op = f'OCP{i:05d}'
+        if origem == 'estoque':
+            cur.execute("INSERT INTO public.pu_inventory (op, peca, projeto, veiculo, local, rack) VALUES (%s, %s, 'BENCH', 'BENCH', %s, 'COLMEIA')",
+                        (op, peca, local))
+        elif origem == 'otimizadas':
+            cur.execute("INSERT INTO public.pu_otimizadas (op, peca, projeto, veiculo, local, rack, tipo) VALUES (%s, %s, 'BENCH', 'BENCH', %s, 'COLMEIA', 'PU')",
+                        (op, peca, local))
+        else:
+            cur.execute("INSERT INTO public.pu_manuais (op, peca, projeto, veiculo, local, rack) VALUES (%s, %s, 'BENCH', 'BENCH', %s, 'COLMEIA')",
+                        (op, peca, local))
+    conn.commit()
+    return len(ocupados)
+
+
+def preparar_lote(conn, pecas, rng):
+    cur = conn.cursor()
+    cur.execute("DELETE FROM public.plano_controle_corte_vidro2")
+    itens = [(f'BEN{i:05d}', rng.choice(TIPOS_PECA)) for i in range(pecas)]
+    for op, peca in itens:
+        cur.execute("""
+            INSERT INTO public.plano_controle_corte_vidro2 (op, peca, projeto, veiculo, id_lote, status, pu_cortado)
+            VALUES (%s, %s, 'BENCH', 'BENCH', %s, 'PROGRAMADO', NULL)
+        """, (op, peca, LOTE_BENCH))
+    conn.commit()
+    return itens
+
+
+def planilha_xlsx(itens):
+    import pandas as pd
+
+    df = pd.DataFrame([{'op': f'XL{op}', 'peca': peca, 'projeto': 'BENCH', 'veiculo': 'BENCH'} for op, peca in itens])
+    buffer = io.BytesIO()
+    df.to_excel(buffer, index=False, engine='openpyxl')
+    return buffer.getvalue()
+
+
+def medir(cenario, ocupacao, funcao):
+    ContadorConsultas.zerar()
+    inicio = time.perf_counter()
+    alocacoes = funcao()
+    segundos = time.perf_counter() - inicio
+    return Resultado(cenario, ocupacao, alocacoes, segundos, ContadorConsultas.total)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    rng = random.Random(args.seed)
+
+    recriar_banco(args)
+    os.environ.update({
+        'DB_HOST': args.host, 'DB_PORT': str(args.port), 'DB_USER': args.usuario,
+        'DB_PSW': args.senha, 'DB_NAME': args.banco,
+    })
+
+    # O esquema precisa existir antes do import: o app prepara as estruturas ao subir
+    conn = psycopg2.connect(host=args.host, port=args.port, user=args.usuario,
+                            password=args.senha, dbname=args.banco)
+    usuario_id = criar_esquema(conn)
+    conn.close()
+
+    import app as app_pu
+
+    def conexao_contada():
+        config = app_pu.DB_CONFIG.copy()
+        config['options'] = '-c timezone=America/Sao_Paulo'
+        return psycopg2.connect(connection_factory=ConexaoContada, **config)
+
+    conn = conexao_contada()
+    app_pu.get_db_connection = conexao_contada
+
+    cliente = app_pu.app.test_client()
+    with cliente.session_transaction() as sessao:
+        sessao['_user_id'] = str(usuario_id)
+        sessao['_fresh'] = True
+
+    resultados = []
+    for fracao in args.ocupacao:
+        ocupados = ocupar(conn, fracao, args.mistura, rng)
+        itens = preparar_lote(conn, args.pecas, rng)
+        print(f'Ocupação {fracao:.0%}: {ocupados} locais ocupados, lote de {len(itens)} peças')
+
+        def sugestoes():
+            conexao = conexao_contada()
+            try:
+                for _, peca in itens[:args.sugestoes]:
+                    app_pu.sugerir_local_armazenamento(peca, set(), conexao)
+            finally:
+                conexao.close()
+            return min(args.sugestoes, len(itens))
+
+        def lote():
+            conexao = conexao_contada()
+            try:
+                alocacoes, sem_local = app_pu.alocar_locais_lote(conexao, [(op, peca, 'BENCH') for op, peca in itens])
+            finally:
+                conexao.close()
+            return len(alocacoes) - len(sem_local)
+
+        def dados():
+            resposta = cliente.get(f'/api/dados?lote={LOTE_BENCH}')
+            corpo = resposta.get_json()
+            if resposta.status_code != 200 or not isinstance(corpo, list):
+                print(f'  /api/dados falhou: {resposta.status_code} {corpo}')
+                return 0
+            return sum(1 for item in corpo if item.get('local') not in ('', 'SEM LOCAL'))
+
+        def upload():
+            arquivo = (io.BytesIO(planilha_xlsx(itens)), 'bench.xlsx')
+            resposta = cliente.post('/api/upload-xlsx', data={'file': arquivo}, content_type='multipart/form-data')
+            corpo = resposta.get_json() or {}
+            if not corpo.get('success'):
+                print(f'  /api/upload-xlsx falhou: {resposta.status_code} {corpo.get("message")}')
+            return corpo.get('processadas', 0)
+
+        for cenario, funcao in (('sugerir_local', sugestoes), ('alocar_lote', lote),
+                                ('api_dados', dados), ('upload_xlsx', upload)):
+            resultados.append(medir(cenario, fracao, funcao))
+
+    conn.close()
+
+    print()
+    print(f'{"cenário":<15}{"ocupação":>10}{"alocações":>11}{"tempo (s)":>11}{"aloc/s":>10}{"consultas/aloc":>16}')
+    for r in resultados:
+        print(f'{r.cenario:<15}{r.ocupacao:>10.0%}{r.alocacoes:>11}{r.segundos:>11.3f}'
+              f'{r.por_segundo:>10.1f}{r.consultas_por_alocacao:>16.2f}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
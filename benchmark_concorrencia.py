@@ -0,0 +1,197 @@
+"""Teste de concorrência da otimização: várias threads otimizando seleções sobrepostas.
+
+Recria o banco descartável do benchmark_alocacao.py, ocupa uma fração dos locais e monta
+um lote sintético no plano (padrão: 200 peças, 3 camadas cada). Cada thread escolhe uma
+parte sobreposta do lote, distribui as peças por locais que também se sobrepõem aos das
+outras threads e chama app.executar_otimizacao (algumas reenviam a mesma seleção, como
+um duplo clique). No fim confere no banco:
+
+- nenhum local guarda duas (op, peça) diferentes (estoque + otimizadas);
+- nenhuma (op, peça) foi gravada duas vezes (mais de um local ou camadas repetidas).
+
+Uso (na pasta do app):
+
+    python benchmark_concorrencia.py --banco app_pu_bench --threads 8 --pecas 200
+"""
+from __future__ import annotations
+
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+
+import psycopg2
+
+from benchmark_alocacao import LOTE_BENCH, TIPOS_PECA, criar_esquema, ocupar, preparar_lote, recriar_banco
+
+# Camadas de cada peça do lote sintético em pu_camadas (L1 + 2x L3)
+CAMADAS_POR_PECA = 3
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', default=os.getenv('DB_PORT', '5432'))
+    parser.add_argument('--usuario', default=os.getenv('DB_USER', 'postgres'))
+    parser.add_argument('--senha', default=os.getenv('DB_PSW', ''))
+    parser.add_argument('--banco', default='app_pu_bench', help='Banco descartável (será recriado)')
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--pecas', type=int, default=200, help='Peças do lote sintético')
+    parser.add_argument('--selecao', type=float, default=0.6, help='Fração do lote escolhida por thread')
+    parser.add_argument('--ocupacao', type=float, default=0.3, help='Fração de locais já ocupados')
+    parser.add_argument('--seed', type=int, default=42)
+    return parser.parse_args(argv)
+
+
+def criar_tabelas_otimizacao(conn):
+    """pu_corte e pu_camadas, que o app espera encontrar prontas."""
+    cur = conn.cursor()
+    cur.execute("""
+        CREATE TABLE public.pu_corte (
+            id SERIAL PRIMARY KEY, op TEXT, peca TEXT, projeto TEXT, veiculo TEXT,
+            user_otimizacao TEXT, tipo TEXT, camada TEXT, data TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        CREATE TABLE public.pu_camadas (
+            id SERIAL PRIMARY KEY, projeto TEXT, peca TEXT, l1 TEXT, l3 TEXT, l3_b TEXT, pecas_especiais TEXT
+        );
+    """)
+    for peca in TIPOS_PECA:
+        cur.execute("INSERT INTO public.pu_camadas (projeto, peca, l1, l3, l3_b) VALUES ('BENCH', %s, '1', '2', '-')",
+                    (peca,))
+    conn.commit()
+
+
+def montar_selecoes(conn, itens, args, rng):
+    """Uma seleção por thread: parte sobreposta do lote em locais livres também sobrepostos.
+
+    Metade das threads repete a seleção de outra (reenvio); as demais sorteiam peças e uma
+    janela de locais deslocada, então a mesma peça aparece em locais diferentes e o mesmo
+    local é escolhido para peças diferentes.
+    """
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT l.local FROM public.pu_locais l
+        LEFT JOIN public.pu_ocupacao o ON o.local = l.local
+        WHERE COALESCE(o.estoque + o.otimizadas, 0) = 0
+        ORDER BY l.local
+    """)
+    livres = [row[0] for row in cur.fetchall()]
+    por_selecao = max(1, int(len(itens) * args.selecao))
+
+    selecoes = []
+    for t in range(args.threads):
+        if t % 2 == 1:
+            selecoes.append([dict(peca) for peca in selecoes[t - 1]])
+            continue
+        escolhidos = rng.sample(itens, por_selecao)
+        inicio = rng.randrange(max(1, len(livres) - por_selecao))
+        selecoes.append([
+            {'op_pai': '0', 'op': op, 'peca': peca, 'projeto': 'BENCH', 'veiculo': 'BENCH',
+             'local': livres[(inicio + i) % len(livres)], 'rack': 'COLMEIA'}
+            for i, (op, peca) in enumerate(escolhidos)
+        ])
+    return selecoes
+
+
+def conferir(conn):
+    """Lista de violações encontradas no banco (vazia = tudo certo)."""
+    cur = conn.cursor()
+    violacoes = []
+
+    cur.execute("""
+        SELECT local, COUNT(DISTINCT (op, peca))
+        FROM (
+            SELECT local, op, peca FROM public.pu_inventory
+            UNION ALL
+            SELECT local, op, peca FROM public.pu_otimizadas WHERE tipo = 'PU'
+        ) ocupantes
+        GROUP BY local
+        HAVING COUNT(DISTINCT (op, peca)) > 1
+    """)
+    violacoes += [f'local {local} com {pecas} peças' for local, pecas in cur.fetchall()]
+
+    cur.execute("""
+        SELECT op, peca, COUNT(*), COUNT(DISTINCT local)
+        FROM public.pu_otimizadas
+        WHERE tipo = 'PU' AND op LIKE 'BEN%%'
+        GROUP BY op, peca
+        HAVING COUNT(*) > %s OR COUNT(DISTINCT local) > 1
+    """, (CAMADAS_POR_PECA,))
+    violacoes += [f'peça {peca} OP {op} gravada {linhas}x em {locais} local(is)' for op, peca, linhas, locais in cur.fetchall()]
+
+    cur.execute("""
+        SELECT op, peca, COUNT(*)
+        FROM public.pu_corte
+        WHERE op LIKE 'BEN%%'
+        GROUP BY op, peca
+        HAVING COUNT(*) > %s
+    """, (CAMADAS_POR_PECA,))
+    violacoes += [f'peça {peca} OP {op} com {linhas} linhas em pu_corte' for op, peca, linhas in cur.fetchall()]
+    return violacoes
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    rng = random.Random(args.seed)
+
+    recriar_banco(args)
+    os.environ.update({
+        'DB_HOST': args.host, 'DB_PORT': str(args.port), 'DB_USER': args.usuario,
+        'DB_PSW': args.senha, 'DB_NAME': args.banco,
+        'LOTES_STATUS_INTERVALO_SEGUNDOS': '0',
+    })
+
+    # O esquema precisa existir antes do import: o app prepara as estruturas ao subir
+    conn = psycopg2.connect(host=args.host, port=args.port, user=args.usuario,
+                            password=args.senha, dbname=args.banco)
+    criar_esquema(conn)
+    criar_tabelas_otimizacao(conn)
+
+    import app as app_pu
+
+    ocupados = ocupar(conn, args.ocupacao, '60,40,0', rng)
+    itens = preparar_lote(conn, args.pecas, rng)
+    selecoes = montar_selecoes(conn, itens, args, rng)
+    print(f'{ocupados} locais ocupados, lote de {len(itens)} peças, '
+          f'{args.threads} thread(s) com {len(selecoes[0])} peças cada')
+
+    resultados = Counter()
+    erros = []
+    largada = threading.Barrier(args.threads)
+
+    def otimizar(selecao):
+        dados = {'pecas': selecao, 'dataCorte': '2026-01-01', 'lote': LOTE_BENCH}
+        largada.wait()
+        resposta, status = app_pu.executar_otimizacao(dados, 'bench')
+        if status != 200:
+            erros.append(resposta.get('message'))
+        resultados['gravou' if resposta.get('success') else 'recusou'] += 1
+
+    threads = [threading.Thread(target=otimizar, args=(selecao,)) for selecao in selecoes]
+    inicio = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    segundos = time.perf_counter() - inicio
+
+    print(f'{resultados["gravou"]} otimização(ões) gravada(s), {resultados["recusou"]} recusada(s) em {segundos:.2f}s')
+    for erro in erros:
+        print(f'Erro: {erro}')
+
+    violacoes = conferir(conn)
+    conn.close()
+    for violacao in violacoes[:20]:
+        print(f'FALHA: {violacao}')
+    if violacoes or erros:
+        print(f'\n{len(violacoes)} violação(ões), {len(erros)} erro(s)')
+        return 1
+    print('\nOK: nenhum local com duas peças e nenhuma (op, peça) gravada duas vezes')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
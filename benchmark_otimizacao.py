@@ -0,0 +1,130 @@
+"""Benchmark da gravação da otimização: um INSERT por camada x INSERTs de várias linhas.
+
+Recria o banco descartável do benchmark_alocacao.py, expande um lote sintético (padrão:
+500 peças, 1 a 4 camadas cada) e grava as linhas em public.pu_otimizadas e public.pu_corte
+das duas formas, com os gatilhos de ocupação do app ativos:
+
+- `linha_a_linha`: um cur.execute por camada e por tabela (caminho antigo do otimizar_pecas);
+- `execute_values`: psycopg2.extras.execute_values com páginas de 1.000 linhas (caminho atual).
+
+Cada rodada é desfeita com rollback, então todas partem das mesmas tabelas.
+
+Uso (na pasta do app):
+
+    python benchmark_otimizacao.py --banco app_pu_bench --pecas 500 --rodadas 3
+"""
+from __future__ import annotations
+
+import argparse
+import os
+import random
+import sys
+import time
+
+import psycopg2
+import psycopg2.extras
+
+from benchmark_alocacao import TIPOS_PECA, criar_esquema, recriar_banco
+
+INSERT_OTIMIZADAS = """
+    INSERT INTO public.pu_otimizadas (op_pai, op, peca, projeto, veiculo, local, rack, user_otimizacao, tipo, camada, lote_vd, lote_pu, data_corte)
+    VALUES %s
+"""
+TEMPLATE_OTIMIZADAS = "(%s, %s, %s, %s, %s, %s, %s, %s, 'PU', %s, %s, %s, %s)"
+INSERT_CORTE = """
+    INSERT INTO public.pu_corte (op, peca, projeto, veiculo, user_otimizacao, tipo, camada)
+    VALUES %s
+"""
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', default=os.getenv('DB_PORT', '5432'))
+    parser.add_argument('--usuario', default=os.getenv('DB_USER', 'postgres'))
+    parser.add_argument('--senha', default=os.getenv('DB_PSW', ''))
+    parser.add_argument('--banco', default='app_pu_bench', help='Banco descartável (será recriado)')
+    parser.add_argument('--pecas', type=int, default=500, help='Peças do lote sintético')
+    parser.add_argument('--rodadas', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=42)
+    return parser.parse_args(argv)
+
+
+def expandir_lote(pecas, rng):
+    """Linhas de pu_otimizadas e pu_corte como o otimizar_pecas monta depois da expansão."""
+    linhas_otimizadas = []
+    linhas_corte = []
+    for i in range(pecas):
+        op = f'BEN{i:05d}'
+        peca = rng.choice(TIPOS_PECA)
+        local = f'{"EFGHIJKLM"[i % 9]}{i // 9 + 1}'
+        camadas = ['L1'] * rng.randint(0, 2) + ['L3'] * rng.randint(1, 2)
+        for camada in camadas:
+            linhas_otimizadas.append(('0', op, peca, 'BENCH', 'BENCH', local, 'COLMEIA', 'bench',
+                                      camada, 'VDBENCH', 'PUBENCH', '2026-01-01'))
+            linhas_corte.append((op, peca, 'BENCH', 'BENCH', 'bench', 'PU', camada))
+    return linhas_otimizadas, linhas_corte
+
+
+def gravar_linha_a_linha(cur, linhas_otimizadas, linhas_corte):
+    insert_otimizadas = INSERT_OTIMIZADAS.replace('%s', TEMPLATE_OTIMIZADAS)
+    insert_corte = INSERT_CORTE.replace('%s', '(%s, %s, %s, %s, %s, %s, %s)')
+    for linha in linhas_otimizadas:
+        cur.execute(insert_otimizadas, linha)
+    for linha in linhas_corte:
+        cur.execute(insert_corte, linha)
+
+
+def gravar_execute_values(cur, linhas_otimizadas, linhas_corte):
+    psycopg2.extras.execute_values(cur, INSERT_OTIMIZADAS, linhas_otimizadas, template=TEMPLATE_OTIMIZADAS, page_size=1000)
+    psycopg2.extras.execute_values(cur, INSERT_CORTE, linhas_corte, page_size=1000)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    rng = random.Random(args.seed)
+
+    recriar_banco(args)
+    os.environ.update({
+        'DB_HOST': args.host, 'DB_PORT': str(args.port), 'DB_USER': args.usuario,
+        'DB_PSW': args.senha, 'DB_NAME': args.banco,
+    })
+    conn = psycopg2.connect(host=args.host, port=args.port, user=args.usuario,
+                            password=args.senha, dbname=args.banco)
+    criar_esquema(conn)
+    conn.cursor().execute("""
+        CREATE TABLE public.pu_corte (
+            id SERIAL PRIMARY KEY, op TEXT, peca TEXT, projeto TEXT, veiculo TEXT,
+            user_otimizacao TEXT, tipo TEXT, camada TEXT, data TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    conn.commit()
+
+    # Importar o app cria pu_otimizadas e os gatilhos de ocupação, como em produção
+    import app  # noqa: F401
+
+    linhas_otimizadas, linhas_corte = expandir_lote(args.pecas, rng)
+    print(f'Lote de {args.pecas} peças: {len(linhas_otimizadas)} linha(s) por tabela')
+
+    tempos = {'linha_a_linha': [], 'execute_values': []}
+    for _ in range(args.rodadas):
+        for nome, gravar in (('linha_a_linha', gravar_linha_a_linha), ('execute_values', gravar_execute_values)):
+            cur = conn.cursor()
+            inicio = time.perf_counter()
+            gravar(cur, linhas_otimizadas, linhas_corte)
+            tempos[nome].append(time.perf_counter() - inicio)
+            conn.rollback()
+    conn.close()
+
+    linhas = len(linhas_otimizadas) + len(linhas_corte)
+    print()
+    print(f'{"caminho":<16}{"melhor (s)":>12}{"média (s)":>12}{"linhas/s":>12}')
+    for nome, amostras in tempos.items():
+        melhor = min(amostras)
+        print(f'{nome:<16}{melhor:>12.3f}{sum(amostras) / len(amostras):>12.3f}{linhas / melhor:>12.0f}')
+    print(f'\nGanho: {min(tempos["linha_a_linha"]) / min(tempos["execute_values"]):.1f}x')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,18 @@
+// Mesma Idempotency-Key enquanto o mesmo envio não recebe resposta definitiva: o reenvio depois
+// de uma queda de rede, timeout do proxy (5xx) ou 409 (envio anterior ainda em andamento)
+// devolve o resultado já gravado no servidor
+const chavesIdempotencia = {};
+
+function chaveIdempotencia(corpo) {
+    if (!chavesIdempotencia[corpo]) {
+        chavesIdempotencia[corpo] = Date.now().toString(36) + Math.random().toString(36).slice(2);
+    }
+    return chavesIdempotencia[corpo];
+}
+
+function liberarChaveIdempotencia(corpo, status) {
+    // Só a resposta definitiva (2xx ou 4xx que não seja 409) encerra o envio
+    if ((status >= 200 && status < 300) || (status >= 400 && status < 500 && status !== 409)) {
+        delete chavesIdempotencia[corpo];
+    }
+}
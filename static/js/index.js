@@ -76,6 +76,7 @@ async function coletarDados() {
         console.log('Lote selecionado:', lote);
         
         params.append('lote', lote);
+        params.append('estrategia', document.getElementById('estrategiaAlocacao').value);
         
         const url = '/api/dados?' + params.toString();
         console.log('URL da requisição:', url);
@@ -216,8 +217,6 @@ async function otimizarPecas() {
         return;
     }
     
-    alert(`${checkboxes.length} peças selecionadas. Iniciando otimização...`);
-    
     const pecasSelecionadas = Array.from(checkboxes).map(cb => {
         const cells = cb.closest('tr').querySelectorAll('td');
         return {
@@ -231,14 +230,39 @@ async function otimizarPecas() {
         };
     });
     
+    // Prévia (dry_run): mostra o que será gravado e pede confirmação antes de otimizar
+    showLoading('Calculando prévia da otimização...');
+    try {
+        const response = await fetch('/api/otimizar-pecas', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ pecas: pecasSelecionadas, dataCorte: dataCorte, lote: lote, dry_run: true })
+        });
+        const previa = await response.json();
+        hideLoading();
+        if (!previa.success) {
+            showPopup(`Erro: ${previa.message}`, true);
+            return;
+        }
+        if (!confirm(`${previa.message}\n\nConfirmar a otimização?`)) return;
+    } catch (error) {
+        hideLoading();
+        alert(`Erro na requisição: ${error.message}`);
+        return;
+    }
+    
     showLoading('Otimizando peças...');
     
     try {
+        // Otimizações grandes rodam em segundo plano; a tela acompanha o job até terminar
+        const assincrono = pecasSelecionadas.length >= OTIMIZACAO_ASSINCRONA_MIN_PECAS;
+        const corpo = JSON.stringify({ pecas: pecasSelecionadas, dataCorte: dataCorte, lote: lote, assincrono: assincrono });
         const response = await fetch('/api/otimizar-pecas', {
             method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify({ pecas: pecasSelecionadas, dataCorte: dataCorte, lote: lote })
+            headers: { 'Content-Type': 'application/json', 'Idempotency-Key': chaveIdempotencia(corpo) },
+            body: corpo
         });
+        liberarChaveIdempotencia(corpo, response.status);
         
         if (!response.ok) {
             const errorText = await response.text();
@@ -247,7 +271,10 @@ async function otimizarPecas() {
             return;
         }
         
-        const result = await response.json();
+        let result = await response.json();
+        if (assincrono && result.job_id) {
+            result = await acompanharJob(result.status_url, pecasSelecionadas.length);
+        }
         hideLoading();
         
         if (result.success) {
@@ -268,6 +295,26 @@ async function otimizarPecas() {
     }
 }
 
+const OTIMIZACAO_ASSINCRONA_MIN_PECAS = 100;
+
+async function acompanharJob(statusUrl, totalPecas) {
+    while (true) {
+        await new Promise(resolve => setTimeout(resolve, 2000));
+        const response = await fetch(statusUrl);
+        if (!response.ok) {
+            return { success: false, message: `Erro HTTP ${response.status} ao consultar o andamento da otimização` };
+        }
+        const job = await response.json();
+        if (job.resultado) {
+            return job.resultado;
+        }
+        const messageEl = document.getElementById('loadingMessage');
+        if (messageEl) {
+            messageEl.textContent = `Otimizando peças... ${job.processadas}/${totalPecas} (${job.inseridas} linha(s))`;
+        }
+    }
+}
+
 async function gerarXML() {
     const checkboxes = document.querySelectorAll('.row-checkbox:checked');
     if (checkboxes.length === 0) return showPopup('Selecione pelo menos um item para gerar o XML.', true);
@@ -803,6 +850,7 @@ async function processarArquivo() {
     
     const formData = new FormData();
     formData.append('file', selectedFile);
+    formData.append('estrategia', document.getElementById('estrategiaAlocacao').value);
     
     showLoading('Processando arquivo XLSX...');
     
@@ -83,11 +83,13 @@ async function enviarParaEstoque() {
     showLoading('Enviando para estoque...');
     
     try {
+        const corpo = JSON.stringify({ ids });
         const response = await fetch('/api/enviar-estoque', {
             method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify({ ids })
+            headers: { 'Content-Type': 'application/json', 'Idempotency-Key': chaveIdempotencia(corpo) },
+            body: corpo
         });
+        liberarChaveIdempotencia(corpo, response.status);
         
         const result = await response.json();
         
@@ -125,11 +127,13 @@ async function enviarPecaIndividual(id) {
     showLoading('Enviando peça para estoque...');
     
     try {
+        const corpo = JSON.stringify({ ids: [id] });
         const response = await fetch('/api/enviar-estoque', {
             method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify({ ids: [id] })
+            headers: { 'Content-Type': 'application/json', 'Idempotency-Key': chaveIdempotencia(corpo) },
+            body: corpo
         });
+        liberarChaveIdempotencia(corpo, response.status);
         
         const result = await response.json();
         